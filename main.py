@@ -1,37 +1,92 @@
 from flask import (
     Flask,
+    make_response,
     render_template,
     redirect,
     url_for,
     request,
     jsonify,
     send_from_directory,
+    stream_with_context,
     flash,
+    abort,
+    g,
 )
 from flask_bootstrap import Bootstrap5
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    mapped_column,
+    relationship,
+    joinedload,
+)
 from sqlalchemy import (
     Integer,
+    SmallInteger,
     String,
     Float,
     Boolean,
+    Date,
+    DateTime,
     Enum,
     JSON,
     Column,
     Text,
     ForeignKey,
     Table,
+    Index,
     cast,
+    update,
+    delete,
+    insert,
+    func,
+    inspect,
+    text,
 )
+from sqlalchemy.exc import IntegrityError
 import json
+import click
+from collections import namedtuple, defaultdict
+from functools import partial, wraps
 from dotenv import load_dotenv
 import os
-from static.utils.geo_utils import get_boroughs_data, find_borough
+from static.utils.geo_utils import (
+    find_borough,
+    find_boroughs,
+    build_boroughs_cache,
+    CafeGrid,
+)
+from static.utils.slug_utils import load_slugged_names, slugify
+from static.utils.image_utils import ImageJobs, make_variants
+from static.utils.asset_utils import (
+    build_asset_manifest,
+    load_asset_manifest,
+    manifest_digest,
+    unfingerprinted,
+)
+from static.utils.import_utils import read_places, chunked, normalize_place
+from static.utils.backup_utils import (
+    backup_lines,
+    gzip_stream,
+    write_backup,
+    read_backup,
+)
+from static.utils.page_cache import make_page_cache
+from static.utils.place_cache import PlaceIndex
+from static.utils.search_utils import SearchIndex
+from static.utils.score_utils import (
+    BASE_SCORES,
+    DEFAULT_BASE_SCORE,
+    base_scores,
+    format_scores,
+    like_level_score,
+)
 import re
-from datetime import datetime
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
 import math
-import requests
+import time
 from typing import List
 from flask_login import (
     UserMixin,
@@ -42,14 +97,21 @@ from flask_login import (
     login_required,
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-
-# from static.utils.format_open_hours import format_opening_hours, day_abbreviations
+from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+import hashlib
+import mimetypes
+
+from static.utils.format_open_hours import (
+    format_opening_hours,
+    opening_intervals,
+    is_open_at,
+    london_now,
+)
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Obtain London boroughs geo_data
-boroughs_data = get_boroughs_data()
 with open("data/borough_coordinates.json", "r") as json_file:
     borough_coords = json.load(json_file)
 
@@ -78,6 +140,11 @@ db = SQLAlchemy(model_class=Base)
 db.init_app(app)
 
 
+def utc_now():
+    # Stored without a timezone, as SQLite doesn't keep one
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 # Association table for the many-to-many relationship between users and cafes
 user_cafe_association = Table(
     "user_cafe",
@@ -85,7 +152,11 @@ user_cafe_association = Table(
     Column("user_id", Integer, ForeignKey("users.id"), primary_key=True),
     Column("cafe_id", Integer, ForeignKey("cafes.id"), primary_key=True),
     Column("like_level", String, default="unknown"),
+    # No longer written or read: a user's score is derived from the cafe's score and their
+    # like_level by like_level_score()
     Column("score", String, default="XX"),
+    # The (user_id, cafe_id) primary key already serves lookups by user, this one is for by cafe
+    Index("ix_user_cafe_cafe_id", "cafe_id"),
 )
 
 
@@ -99,6 +170,8 @@ class User(UserMixin, db.Model):
     occupation: Mapped[str] = mapped_column(String(250), default="Friendly Co-Worker")
     privacy: Mapped[str] = mapped_column(String(250), default="0")
     photo_name: Mapped[str] = mapped_column(String(250), default="anonymous.png")
+    # Resized copies of the photo, see make_variants
+    photo_variants = Column(JSON, nullable=True)
     visited_cafes: Mapped[List["Cafe"]] = relationship(
         "Cafe", secondary=user_cafe_association, back_populates="visitors"
     )
@@ -113,13 +186,8 @@ class User(UserMixin, db.Model):
         return association.like_level if association else "unknown"
 
     def get_score(self, cafe_id):
-        association = (
-            db.session.query(user_cafe_association)
-            .filter_by(user_id=self.id, cafe_id=cafe_id)
-            .first()
-        )
         cafe = db.get_or_404(Cafe, cafe_id)
-        return association.score if association else cafe.score
+        return like_level_score(cafe.score, self.get_like_level(cafe_id))
 
     def get_review_for_cafe(self, cafe_id):
         review = (
@@ -132,6 +200,12 @@ class User(UserMixin, db.Model):
 
 class Cafe(db.Model):
     __tablename__ = "cafes"
+    __table_args__ = (
+        # Borough listings filter on borough and reported_closed and order by score
+        Index(
+            "ix_cafes_borough_closed_score", "borough", "reported_closed", "score_value"
+        ),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     place_id: Mapped[str] = mapped_column(String, unique=True, nullable=False)
     name: Mapped[str] = mapped_column(String(250), nullable=False)
@@ -139,34 +213,164 @@ class Cafe(db.Model):
     postal_code: Mapped[str] = mapped_column(String(250), nullable=False)
     borough: Mapped[str] = mapped_column(String(250), nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
+    # Resized copies of the thumbnail, see make_variants
+    img_variants = Column(JSON, nullable=True)
     map_url: Mapped[str] = mapped_column(String(250), nullable=False)
     lat: Mapped[float] = mapped_column(Float, nullable=False)
     lng: Mapped[float] = mapped_column(Float, nullable=False)
     opening_hours = Column(JSON, default={})
+    # The same hours as [start, end) minutes since Monday 00:00, for "open now" checks
+    opening_intervals = Column(JSON, nullable=True)
     criterion = Column(JSON, default={})
     score: Mapped[str] = mapped_column(String(2), nullable=False, default="XX")
+    # Same score as an integer (NULL while it is "XX") so cafes can be ranked in SQL
+    score_value: Mapped[int] = mapped_column(Integer, nullable=True, index=True)
     visitors: Mapped[List["User"]] = relationship(
         "User", secondary=user_cafe_association, back_populates="visited_cafes"
     )
     reviews: Mapped[List["Review"]] = relationship(back_populates="parent_cafe")
+    criteria: Mapped["CafeCriteria"] = relationship(
+        back_populates="cafe", cascade="all, delete-orphan"
+    )
+    slug: Mapped[str] = mapped_column(String(250), nullable=True, index=True)
+    borough_info: Mapped["Borough"] = relationship(
+        primaryjoin="foreign(Cafe.borough) == Borough.name",
+        viewonly=True,
+        lazy="joined",
+    )
     reported_closed: Mapped[str] = mapped_column(
         String(250), nullable=False, default="False"
     )
+    # Bumped by every write that changes the cafe page, for conditional GETs
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=True, default=utc_now
+    )
+    # Counts of the cafe's reviews and its users' like_levels, kept up to date by the routes
+    # that write them (see add_to_cafe_stats) so pages don't have to count rows. The
+    # reconcile-cafe-stats command recounts them
+    review_count: Mapped[int] = mapped_column(Integer, nullable=True, default=0)
+    latest_review_on: Mapped[date] = mapped_column(Date, nullable=True)
+    likes_low: Mapped[int] = mapped_column(Integer, nullable=True, default=0)
+    likes_medium: Mapped[int] = mapped_column(Integer, nullable=True, default=0)
+    likes_high: Mapped[int] = mapped_column(Integer, nullable=True, default=0)
+
+    @property
+    def like_count(self):
+        return (self.likes_low or 0) + (self.likes_medium or 0) + (self.likes_high or 0)
+
+    @property
+    def like_average(self):
+        # From 1 (low) to 3 (high), or None until someone has rated the cafe
+        if not self.like_count:
+            return None
+        total = (
+            (self.likes_low or 0)
+            + 2 * (self.likes_medium or 0)
+            + 3 * (self.likes_high or 0)
+        )
+        return round(total / self.like_count, 2)
+
+    def set_score(self, score):
+        self.score = score
+        self.score_value = None if score == "XX" else int(score)
+
+    def set_criterion(self, criterion):
+        # Writes the JSON blob and its indexed copy in cafe_criteria together
+        self.criterion = criterion
+        if self.criteria is None:
+            self.criteria = CafeCriteria()
+        for key, code in encode_criteria(criterion).items():
+            setattr(self.criteria, key, code)
+
+
+# Keys of Cafe.criterion, in the order the forms list them
+CRITERIA = (
+    "wifi",
+    "sockets",
+    "long_stay",
+    "tables",
+    "quiet",
+    "calls",
+    "vibe",
+    "groups",
+    "coffee",
+    "food",
+    "veggie",
+    "alcohol",
+    "credit_cards",
+    "light",
+    "outdoor",
+    "spacious",
+    "toilets",
+    "access",
+    "ac",
+    "pets",
+    "parking",
+)
+# Cafe.criterion as one small integer column per criterion, so criteria searches can use
+# indexes instead of decoding every cafe's JSON
+CRITERIA_CODES = {"unknown": 0, "low": 1, "medium": 2, "high": 3}
+
+
+def encode_criteria(criterion):
+    return {key: CRITERIA_CODES.get(criterion.get(key), 0) for key in CRITERIA}
+
 
-    def get_numeric_score(self):
-        # Convert 'XX' to a numeric value (e.g., -1 for the lowest score or a very high number for the highest)
-        print(self.score)
-        if self.score == "XX":
-            return -1  # or a very high number depending on your sorting preference
-            print("XX")
-        return float(self.score)
+class CafeCriteria(db.Model):
+    __tablename__ = "cafe_criteria"
+    cafe_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("cafes.id"), primary_key=True
+    )
+    cafe: Mapped["Cafe"] = relationship(back_populates="criteria")
+    wifi: Mapped[int] = mapped_column(SmallInteger, default=0, index=True)
+    sockets: Mapped[int] = mapped_column(SmallInteger, default=0, index=True)
+    long_stay: Mapped[int] = mapped_column(SmallInteger, default=0)
+    tables: Mapped[int] = mapped_column(SmallInteger, default=0)
+    quiet: Mapped[int] = mapped_column(SmallInteger, default=0, index=True)
+    calls: Mapped[int] = mapped_column(SmallInteger, default=0)
+    vibe: Mapped[int] = mapped_column(SmallInteger, default=0)
+    groups: Mapped[int] = mapped_column(SmallInteger, default=0)
+    coffee: Mapped[int] = mapped_column(SmallInteger, default=0)
+    food: Mapped[int] = mapped_column(SmallInteger, default=0)
+    veggie: Mapped[int] = mapped_column(SmallInteger, default=0)
+    alcohol: Mapped[int] = mapped_column(SmallInteger, default=0)
+    credit_cards: Mapped[int] = mapped_column(SmallInteger, default=0)
+    light: Mapped[int] = mapped_column(SmallInteger, default=0)
+    outdoor: Mapped[int] = mapped_column(SmallInteger, default=0)
+    spacious: Mapped[int] = mapped_column(SmallInteger, default=0)
+    toilets: Mapped[int] = mapped_column(SmallInteger, default=0)
+    access: Mapped[int] = mapped_column(SmallInteger, default=0)
+    ac: Mapped[int] = mapped_column(SmallInteger, default=0)
+    pets: Mapped[int] = mapped_column(SmallInteger, default=0)
+    parking: Mapped[int] = mapped_column(SmallInteger, default=0)
+
+
+class Borough(db.Model):
+    __tablename__ = "boroughs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
+    slug: Mapped[str] = mapped_column(
+        String(250), unique=True, index=True, nullable=False
+    )
+    # Bumped whenever one of the borough's cafes changes, for conditional GETs
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=True, default=utc_now
+    )
 
 
 class Review(db.Model):
     __tablename__ = "reviews"
+    __table_args__ = (
+        # One review per user per cafe
+        Index("ix_reviews_author_cafe", "author_id", "cafe_id", unique=True),
+        # A cafe's reviews, most recently written or edited first
+        Index("ix_reviews_cafe_updated", "cafe_id", "updated_at", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
     date: Mapped[str] = mapped_column(String(250), nullable=False)
+    # When the review was written or last edited; `date` only keeps the day, for display
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     author: Mapped["User"] = relationship(back_populates="reviews")
     author_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
     parent_cafe: Mapped["Cafe"] = relationship(back_populates="reviews")
@@ -176,132 +380,420 @@ class Review(db.Model):
 with app.app_context():
     db.create_all()
 
+# Slugged names from before slugs were stored in the db; only read by the slug backfill
+SLUGGED_NAMES_PATH = "data/slugged_names.json"
+
 
 # -------------------------------------------FUNCTIONS---------------------------------------------------------------------------
-# Here we create a function to convert words into url format e.g. convert the string London Bridge to london-bridge
-def create_slug(text):
-    file_path = "data/slugged_names.json"
+REVIEWS_PER_PAGE = 10
 
-    try:
-        with open(file_path, "r") as file:
-            content = file.read()
-            if content.strip():
-                data = json.loads(content)
-            else:
-                data = {}
-    except FileNotFoundError:
-        data = {}
-    except json.JSONDecodeError:
-        data = {}
 
-    slug = re.sub(r"[^a-z0-9-]", "", text.lower().replace(" ", "-"))
+def get_or_create_borough(name):
+    borough = db.session.query(Borough).filter_by(name=name).first()
+    if not borough:
+        borough = Borough(name=name, slug=slugify(name))
+        db.session.add(borough)
+    return borough
 
-    if text not in data:
-        data[text] = slug
 
-        with open(file_path, "w") as file:
-            json.dump(data, file, indent=4)
+# Per-cafe values that depend on the logged in user, precomputed for list pages
+CafeView = namedtuple("CafeView", ["like_level", "score"])
 
-        print(f"Slug for '{text}' added successfully: {slug}")
-    else:
-        print(f"Slug for '{text}' already exists: {data[text]}")
 
+def get_cafes_with_views(borough):
+    # One query for the borough's open cafes plus the current user's like_level/score rows,
+    # instead of two association queries and a cafe lookup per cafe in the template
+    user_id = current_user.id if current_user.is_authenticated else None
+    association = user_cafe_association.c
+    rows = db.session.execute(
+        db.select(Cafe, association.like_level)
+        .outerjoin(
+            user_cafe_association,
+            (association.cafe_id == Cafe.id) & (association.user_id == user_id),
+        )
+        .where(Cafe.borough == borough, Cafe.reported_closed == "False")
+        .order_by(Cafe.score_value.desc().nulls_last(), Cafe.id)
+    ).all()
+
+    cafes = []
+    cafe_views = {}
+    for cafe, like_level in rows:
+        cafes.append(cafe)
+        like_level = like_level or "unknown"
+        cafe_views[cafe.id] = CafeView(
+            like_level, like_level_score(cafe.score, like_level)
+        )
+    return cafes, cafe_views
 
-def make_slug(text):
-    with open("data/slugged_names.json", "r") as file:
-        data = json.load(file)
-    return data[text]
 
+# Borough names with their open cafe counts and average scores, for the boroughs index.
+# Cached per worker; writes in this worker clear it, and the TTL bounds how stale it can be
+# after a write in another worker
+BOROUGH_SUMMARY_TTL = 60
+BoroughSummary = namedtuple(
+    "BoroughSummary", ["name", "slug", "cafe_count", "average_score"]
+)
+borough_summary_cache = {"summary": None, "expires": 0}
+
+
+def get_borough_summary():
+    if (
+        borough_summary_cache["summary"] is None
+        or time.monotonic() > borough_summary_cache["expires"]
+    ):
+        rows = db.session.execute(
+            db.select(
+                Borough.name,
+                Borough.slug,
+                func.count(Cafe.id),
+                func.avg(Cafe.score_value),
+            )
+            .join(Cafe, Cafe.borough == Borough.name)
+            .where(Cafe.reported_closed == "False")
+            .group_by(Borough.name, Borough.slug)
+            .order_by(Borough.name)
+        ).all()
+        borough_summary_cache["summary"] = [
+            BoroughSummary(
+                name, slug, cafe_count, None if average is None else round(average)
+            )
+            for name, slug, cafe_count, average in rows
+        ]
+        borough_summary_cache["expires"] = time.monotonic() + BOROUGH_SUMMARY_TTL
+    return borough_summary_cache["summary"]
 
-def make_slug_inverse(slug):
-    with open("data/slugged_names.json", "r") as file:
-        data = json.load(file)
-    for key, val in data.items():
-        if val == slug:
-            return key
 
+def invalidate_borough_summary():
+    borough_summary_cache["summary"] = None
 
-def check_cafe_in_db(place_id):
-    cafe = db.session.query(Cafe).filter_by(place_id=place_id).first()
-    if cafe:
-        print(cafe.id)
-        return {
-            "exists": True,
-            "id": cafe.id,
-            "location_slug": make_slug(cafe.borough),
-            "cafe_slug": make_slug(cafe.name),
-        }
-    return {"exists": False}
+
+# Rendered pages for anonymous visitors. In-process by default; set PAGE_CACHE_URL to a
+# redis:// url to share one cache (and its invalidations) between all workers
+page_cache = make_page_cache(
+    os.getenv("PAGE_CACHE_URL"), int(os.getenv("PAGE_CACHE_TTL", "60"))
+)
+
+
+def cache_page_for_anonymous(view):
+    # Logged in users see their own likes and scores, so their pages are always rendered fresh
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_user.is_authenticated or request.method != "GET":
+            return view(*args, **kwargs)
+        # Pages highlight today's opening hours, so the day is part of the key. Under
+        # conditional_for_anonymous the validator is too, so a page rendered before a write
+        # in another worker is never served under the ETag of the newer data
+        version = g.get("page_version", "")
+        key = f"{london_now().strftime('%a')}:{version}:{request.full_path}"
+        page = page_cache.get(key)
+        if page is None:
+            page = view(*args, **kwargs)
+            if isinstance(page, str):
+                page_cache.set(key, page)
+        return page
+
+    return wrapper
+
+
+def touch_cafe(cafe):
+    # Marks the cafe page, its borough page and the home page as changed
+    now = utc_now()
+    cafe.updated_at = now
+    db.session.execute(
+        update(Borough).where(Borough.name == cafe.borough).values(updated_at=now)
+    )
 
 
-def format_opening_hours(weekday_text):
-    day_abbreviations = {
-        "Monday": "Mon",
-        "Tuesday": "Tue",
-        "Wednesday": "Wed",
-        "Thursday": "Thu",
-        "Friday": "Fri",
-        "Saturday": "Sat",
-        "Sunday": "Sun",
+def touch_reviewed_cafes(user_id):
+    # Cafe pages show their reviewers' names, photos and privacy choice, so a profile change
+    # marks every cafe the user has reviewed, and their boroughs, as changed
+    now = utc_now()
+    reviewed = db.select(Review.cafe_id).where(Review.author_id == user_id)
+    db.session.execute(update(Cafe).where(Cafe.id.in_(reviewed)).values(updated_at=now))
+    db.session.execute(
+        update(Borough)
+        .where(Borough.name.in_(db.select(Cafe.borough).where(Cafe.id.in_(reviewed))))
+        .values(updated_at=now)
+    )
+
+
+# Review.date is stored as display text in this format
+REVIEW_DATE_FORMAT = "%B %d, %Y"
+LIKE_LEVEL_COLUMNS = {
+    "low": "likes_low",
+    "medium": "likes_medium",
+    "high": "likes_high",
+}
+CAFE_STATS_COLUMNS = ("review_count", "latest_review_on", *LIKE_LEVEL_COLUMNS.values())
+
+
+def add_to_cafe_stats(cafe_id, deltas, **values):
+    # Adds deltas, e.g. {"review_count": 1}, to the cafe's counters in SQL, so concurrent
+    # writes can't overwrite each other's counts. Runs in the caller's transaction, so the
+    # counts change together with the rows they count
+    changes = {
+        column: func.coalesce(getattr(Cafe, column), 0) + delta
+        for column, delta in deltas.items()
+        if delta
     }
+    changes.update(values)
+    if changes:
+        db.session.execute(update(Cafe).where(Cafe.id == cafe_id).values(changes))
+
+
+def like_level_deltas(old_level, new_level):
+    deltas = Counter()
+    if old_level in LIKE_LEVEL_COLUMNS:
+        deltas[LIKE_LEVEL_COLUMNS[old_level]] -= 1
+    if new_level in LIKE_LEVEL_COLUMNS:
+        deltas[LIKE_LEVEL_COLUMNS[new_level]] += 1
+    return deltas
+
+
+def parse_review_date(text):
     try:
-        weekday_text = (
-            weekday_text.replace(" ", " ")
-            .replace("–", "-")
-            .replace("\u202f", " ")
-            .replace("\u2009", " ")
-        )
-        first_split = re.split(",(?=\w)", weekday_text)
-        opening_hours_dict = {}
-
-        for i in first_split:
-            weekday, time_range = i.split(":", 1)
-            weekday = weekday.strip()
-            time_range = time_range.strip()
-
-            if time_range.lower() == "closed":
-                opening_hours_dict[day_abbreviations[weekday]] = "Closed"
-                continue
-            elif time_range.lower() == "open 24 hours":
-                opening_hours_dict[day_abbreviations[weekday]] = "Open 24 hours"
-                continue
-            elif "hours might differ" in time_range.lower():
-                opening_hours_dict[day_abbreviations[weekday]] = time_range
-                continue
+        return datetime.strptime(text, REVIEW_DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
 
-            time_range = re.sub(r"\s*\(.*?\)", "", time_range.strip())
-            start_time, end_time = time_range.split("-")
-            try:
-                formatted_start_time = datetime.strptime(
-                    start_time.strip(), "%I:%M %p"
-                ).strftime("%H:%M")
-            except ValueError:
-                formatted_start_time = datetime.strptime(
-                    start_time.strip(), "%H:%M"
-                ).strftime("%H:%M")
-            try:
-                formatted_end_time = datetime.strptime(
-                    end_time.strip(), "%I:%M %p"
-                ).strftime("%H:%M")
-            except ValueError:
-                formatted_end_time = datetime.strptime(
-                    end_time.strip(), "%H:%M"
-                ).strftime("%H:%M")
-            opening_hours_dict[day_abbreviations[weekday]] = (
-                f"{formatted_start_time} – {formatted_end_time}"
+
+def latest_review_on(cafe_id):
+    review_dates = [
+        parse_review_date(text)
+        for text in db.session.scalars(
+            db.select(Review.date).where(Review.cafe_id == cafe_id)
+        )
+    ]
+    return max(filter(None, review_dates), default=None)
+
+
+# Newest template change, so a deploy with new templates also changes every ETag
+TEMPLATES_MODIFIED = datetime.fromtimestamp(
+    max(
+        os.path.getmtime(os.path.join(app.root_path, "templates", name))
+        for name in os.listdir(os.path.join(app.root_path, "templates"))
+    ),
+    timezone.utc,
+)
+
+
+def conditional_for_anonymous(get_updated_at):
+    # Answers If-None-Match / If-Modified-Since with a 304 before the view queries or renders
+    # anything. get_updated_at gets the view's arguments and returns when its data last changed
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if current_user.is_authenticated or request.method != "GET":
+                return view(*args, **kwargs)
+
+            last_modified = max(
+                TEMPLATES_MODIFIED,
+                # Pages highlight today's opening hours, so they change at midnight
+                london_now().replace(hour=0, minute=0, second=0, microsecond=0),
             )
-        return opening_hours_dict
-    except Exception as e:
-        print(f"Error processing {i}: {e}")
-        return {
-            "Mon": "N/A",
-            "Tue": "N/A",
-            "Wed": "N/A",
-            "Thu": "N/A",
-            "Fri": "N/A",
-            "Sat": "N/A",
-            "Sun": "N/A",
-        }
+            updated_at = get_updated_at(*args, **kwargs)
+            if updated_at:
+                last_modified = max(
+                    last_modified, updated_at.replace(tzinfo=timezone.utc)
+                )
+            # Full precision for the ETag and page cache, so two writes in the same second
+            # still give different versions. HTTP dates only have whole seconds; a client
+            # sending If-None-Match has that checked instead of If-Modified-Since
+            g.page_version = f"{last_modified.isoformat()}:{ASSETS_VERSION}"
+            etag = hashlib.sha1(
+                f"{request.full_path}:{g.page_version}".encode()
+            ).hexdigest()
+            last_modified = last_modified.replace(microsecond=0)
+
+            if is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified
+            ):
+                response = make_response(view(*args, **kwargs))
+            else:
+                response = app.response_class(status=304)
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+# Grid index of open cafes' coordinates for the nearby API, rebuilt on the first search after
+# a write in this worker, or after the TTL for writes in other workers
+CAFE_GRID_TTL = 60
+cafe_grid_cache = {"grid": None, "expires": 0}
+
+
+def get_cafe_grid():
+    if cafe_grid_cache["grid"] is None or time.monotonic() > cafe_grid_cache["expires"]:
+        rows = db.session.execute(
+            db.select(Cafe.id, Cafe.lat, Cafe.lng).where(
+                Cafe.reported_closed == "False"
+            )
+        ).all()
+        cafe_grid_cache["grid"] = CafeGrid(
+            [row.id for row in rows],
+            [row.lat for row in rows],
+            [row.lng for row in rows],
+        )
+        cafe_grid_cache["expires"] = time.monotonic() + CAFE_GRID_TTL
+    return cafe_grid_cache["grid"]
+
+
+def invalidate_cafe_grid():
+    cafe_grid_cache["grid"] = None
+
+
+# Search index of open cafes' names, addresses and reviews. Built on the first search, then
+# kept up to date by re-indexing the cafes whose updated_at has moved on (every write to a
+# cafe or its reviews touches it): straight after a write in this worker, or after
+# SEARCH_REFRESH_TTL for writes elsewhere. Rebuilt from scratch every SEARCH_REBUILD_TTL
+SEARCH_REFRESH_TTL = 30
+SEARCH_REBUILD_TTL = 3600
+# updated_at is set when a write runs but only visible once it commits, so a slow transaction
+# can commit an updated_at older than one already seen. Refreshes look back this far to catch it
+SEARCH_REFRESH_OVERLAP = timedelta(seconds=60)
+SEARCH_RESULTS_LIMIT = 20
+search_index_cache = {"index": None, "since": None, "refresh_at": 0, "rebuild_at": 0}
+
+
+def index_cafes(index, cafe_ids=None):
+    # (Re-)indexes the given cafes, or all of them, and returns their newest updated_at
+    cafes_query = db.select(
+        Cafe.id,
+        Cafe.name,
+        Cafe.address,
+        Cafe.postal_code,
+        Cafe.borough,
+        Cafe.reported_closed,
+        Cafe.updated_at,
+    )
+    reviews_query = db.select(Review.cafe_id, Review.text)
+    if cafe_ids is not None:
+        cafes_query = cafes_query.where(Cafe.id.in_(cafe_ids))
+        reviews_query = reviews_query.where(Review.cafe_id.in_(cafe_ids))
+    reviews = defaultdict(list)
+    for cafe_id, review_text in db.session.execute(reviews_query):
+        reviews[cafe_id].append(review_text)
+
+    newest = None
+    for cafe in db.session.execute(cafes_query):
+        if cafe.reported_closed == "True":
+            index.remove_cafe(cafe.id)
+        else:
+            index.set_cafe(
+                cafe.id,
+                cafe.name,
+                ", ".join(
+                    part
+                    for part in (cafe.address, cafe.postal_code, cafe.borough)
+                    if part
+                ),
+                reviews[cafe.id],
+            )
+        if cafe.updated_at and (newest is None or cafe.updated_at > newest):
+            newest = cafe.updated_at
+    return newest
+
+
+def get_search_index():
+    cache = search_index_cache
+    now = time.monotonic()
+    if cache["index"] is None or now > cache["rebuild_at"]:
+        index = SearchIndex()
+        cache["since"] = index_cafes(index)
+        cache["index"] = index
+        cache["rebuild_at"] = now + SEARCH_REBUILD_TTL
+        cache["refresh_at"] = now + SEARCH_REFRESH_TTL
+    elif now > cache["refresh_at"]:
+        if cache["since"] is None:
+            # No cafe had been written when the index was built (e.g. right after upgrade-db
+            # added updated_at), so any cafe with an updated_at now was written since
+            changed_query = db.select(Cafe.id).where(Cafe.updated_at.is_not(None))
+        else:
+            changed_query = db.select(Cafe.id).where(
+                Cafe.updated_at >= cache["since"] - SEARCH_REFRESH_OVERLAP
+            )
+        changed = db.session.scalars(changed_query).all()
+        if changed:
+            newest = index_cafes(cache["index"], changed)
+            if newest and (cache["since"] is None or newest > cache["since"]):
+                cache["since"] = newest
+        cache["refresh_at"] = now + SEARCH_REFRESH_TTL
+    return cache["index"]
+
+
+def invalidate_search_index():
+    search_index_cache["refresh_at"] = 0
+
+
+def search_cafes(query, limit=SEARCH_RESULTS_LIMIT):
+    # [(cafe, snippet)], best match first
+    matches = get_search_index().search(query, limit)
+    cafes = {
+        cafe.id: cafe
+        for cafe in db.session.scalars(
+            db.select(Cafe).where(Cafe.id.in_([cafe_id for cafe_id, _, _ in matches]))
+        )
+    }
+    return [
+        (cafes[cafe_id], snippet) for cafe_id, _, snippet in matches if cafe_id in cafes
+    ]
+
+
+def invalidate_caches():
+    # Call after any write that changes what a public page shows
+    invalidate_borough_summary()
+    invalidate_cafe_grid()
+    invalidate_search_index()
+    page_cache.invalidate()
+
+
+# Which place_ids are already cafes, for the suggest page's duplicate check. Warmed at startup,
+# added to by suggests, and re-read every PLACE_INDEX_TTL seconds for cafes added elsewhere
+PLACE_INDEX_TTL = 300
+
+
+def load_place_summary(place_id):
+    cafe = db.session.execute(
+        db.select(Cafe.id, Cafe.slug, Borough.slug.label("location_slug"))
+        .outerjoin(Borough, Borough.name == Cafe.borough)
+        .where(Cafe.place_id == place_id)
+    ).first()
+    if cafe is None:
+        return None
+    return {"id": cafe.id, "location_slug": cafe.location_slug, "cafe_slug": cafe.slug}
+
+
+place_index = PlaceIndex(
+    lambda: db.session.scalars(db.select(Cafe.place_id)),
+    load_place_summary,
+    ttl=PLACE_INDEX_TTL,
+)
+with app.app_context():
+    place_index.warm()
+
+
+def check_cafe_in_db(place_id):
+    summary = place_index.get(place_id)
+    if summary:
+        return {"exists": True, **summary}
+    return {"exists": False}
+
+
+def redirect_to_suggested_cafe(place_id):
+    # Where a suggestion of an already listed place ends up: back to rating it if it's still
+    # unrated (e.g. the form was submitted twice), otherwise its page
+    cafe = db.session.execute(
+        db.select(Cafe.id, Cafe.criterion).where(Cafe.place_id == place_id)
+    ).first()
+    if cafe is None:
+        return None
+    endpoint = "show_cafe" if cafe.criterion else "under_review"
+    return redirect(url_for(endpoint, cafe_id=cafe.id))
 
 
 def calculate_score(criterion, like_level):
@@ -309,18 +801,8 @@ def calculate_score(criterion, like_level):
         return "XX"
     score = 0
 
-    base_scores = {
-        "wifi": 11,
-        "sockets": 11,
-        "long_stay": 5.5,
-        "tables": 5.5,
-        "quiet": 3,
-        "calls": 3,
-    }
-    default_base_score = 11 / 15
-
     for key, value in criterion.items():
-        base_score = base_scores.get(key, default_base_score)
+        base_score = BASE_SCORES.get(key, DEFAULT_BASE_SCORE)
 
         if value == "medium":
             score += base_score
@@ -338,15 +820,126 @@ def calculate_score(criterion, like_level):
     return str(int(score))
 
 
-def download_image(url, save_path="image.jpg"):
-    response = requests.get(url)
-    if response.status_code == 200:
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        with open(save_path, "wb") as file:
-            file.write(response.content)
-        return "Image successfully downloaded: " + save_path
-    else:
-        return "Failed to retrieve the image"
+# Thumbnails are downloaded and resized on a background thread pool, so a slow image host never
+# holds up a request. The original's URL is known up front and serves the image once its
+# download job is done; pages switch to the resized variants once they have been made
+THUMBNAILS_DIR = "assets/images/thumbnails"
+PROFILE_PICS_DIR = "assets/images/profile-pics"
+VARIANTS_DIR = "assets/images/variants"
+image_jobs = ImageJobs(max_workers=int(os.getenv("IMAGE_DOWNLOAD_WORKERS", "4")))
+
+
+def thumbnail_path(place_id, name):
+    # Relative to the static folder
+    filename = (
+        f"{re.sub(r'[^A-Za-z0-9_-]', '', place_id or '')}-{slugify(name or '')}.jpg"
+    )
+    return f"{THUMBNAILS_DIR}/{filename}"
+
+
+def build_variants(source_path, kinds):
+    return make_variants(
+        source_path,
+        os.path.join(app.static_folder, VARIANTS_DIR),
+        kinds,
+        prefix=f"{VARIANTS_DIR}/",
+    )
+
+
+def store_cafe_variants(cafe_id, source_path):
+    # Runs on an image job thread (or the CLI), hence its own app context
+    variants = build_variants(source_path, ("card", "detail"))
+    with app.app_context():
+        cafe = db.session.get(Cafe, cafe_id)
+        if cafe:
+            cafe.img_variants = variants
+            touch_cafe(cafe)
+            db.session.commit()
+    invalidate_caches()
+
+
+def store_user_variants(user_id, source_path):
+    variants = build_variants(source_path, ("avatar",))
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        if user:
+            user.photo_variants = variants
+            touch_reviewed_cafes(user.id)
+            db.session.commit()
+    invalidate_caches()
+
+
+def srcset(variants, kind, image_format):
+    return ", ".join(
+        f"{url_for('static', filename=path)} {width}w"
+        for width, path in variants[kind][image_format]
+    )
+
+
+# Static assets are served under URLs containing a hash of their content (see build-assets),
+# so browsers can keep them for a year without ever revalidating. url_for("static") resolves
+# through the manifest; without one (e.g. in development) URLs and caching are left as they are
+ASSET_MAX_AGE = 365 * 24 * 3600
+# Thumbnails and profile pictures keep their names when replaced, so they are only cached for
+# a day. Variants are named after their content, so they never change
+IMAGE_MAX_AGE = 24 * 3600
+static_manifest = load_asset_manifest(app.static_folder)
+fingerprinted_assets = {asset["url"]: asset for asset in static_manifest.values()}
+# Part of every page's ETag, so pages pointing at old fingerprints aren't revalidated
+# after a deploy that only changed CSS or JS
+ASSETS_VERSION = manifest_digest(static_manifest) if static_manifest else ""
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == "static" and values.get("filename") in static_manifest:
+        values["filename"] = static_manifest[values["filename"]]["url"]
+
+
+def serve_static(filename):
+    asset = fingerprinted_assets.get(filename)
+    if asset is None and unfingerprinted(filename) in static_manifest:
+        # A fingerprint from before the last deploy (e.g. in a page cached elsewhere). Serve
+        # the current file, but without the long caching its old name would promise
+        return app.send_static_file(unfingerprinted(filename))
+    if asset is None:
+        response = app.send_static_file(filename)
+        if filename.startswith(f"{VARIANTS_DIR}/"):
+            response.cache_control.max_age = ASSET_MAX_AGE
+            response.cache_control.immutable = True
+        elif filename.startswith("assets/images/"):
+            response.cache_control.max_age = IMAGE_MAX_AGE
+        if response.cache_control.max_age:
+            # Replaces Flask's default of revalidating on every use
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+        return response
+
+    # The pre-compressed copy, if there is one the browser accepts
+    encoding = next(
+        (
+            encoding
+            for encoding in ("br", "gzip")
+            if encoding in asset["encodings"] and encoding in request.accept_encodings
+        ),
+        None,
+    )
+    response = send_from_directory(
+        app.static_folder,
+        asset["encodings"][encoding] if encoding else asset["file"],
+        mimetype=mimetypes.guess_type(asset["file"])[0],
+        max_age=ASSET_MAX_AGE,
+    )
+    if encoding:
+        response.content_encoding = encoding
+    if asset["encodings"]:
+        response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+app.view_functions["static"] = serve_static
 
 
 def get_like_level(self, cafe_id):
@@ -358,25 +951,263 @@ def get_like_level(self, cafe_id):
     return association.like_level
 
 
-def user_has_review_filter(reviews, user_id):
-    return any(review.author.id == user_id for review in reviews)
+def get_reviews_page(cafe_id, before=None, limit=REVIEWS_PER_PAGE):
+    # Most recently written or edited first, with each author loaded in the same query.
+    # Returns the page and the cursor for the next one (None on the last page)
+    query = (
+        db.select(Review)
+        .options(joinedload(Review.author))
+        .where(Review.cafe_id == cafe_id)
+        .order_by(Review.updated_at.desc().nulls_last(), Review.id.desc())
+        .limit(limit + 1)
+    )
+    if before is not None:
+        updated_at, review_id = before
+        if updated_at is None:
+            query = query.where(Review.updated_at.is_(None), Review.id < review_id)
+        else:
+            query = query.where(
+                (Review.updated_at < updated_at)
+                | ((Review.updated_at == updated_at) & (Review.id < review_id))
+                | Review.updated_at.is_(None)
+            )
+    reviews = db.session.execute(query).scalars().all()
+    if len(reviews) <= limit:
+        return reviews, None
+    last = reviews[limit - 1]
+    updated_at = "-" if last.updated_at is None else last.updated_at.isoformat()
+    return reviews[:limit], f"{updated_at}_{last.id}"
+
+
+def parse_reviews_cursor(cursor):
+    # "<updated_at>_<id>" of the last review on the previous page, "-" standing in for none
+    try:
+        updated_at, review_id = cursor.rsplit("_", 1)
+        updated_at = None if updated_at == "-" else datetime.fromisoformat(updated_at)
+        return updated_at, int(review_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor {cursor}")
+
+
+CAFES_API_LIMIT = 20
+NEARBY_RADIUS = 1000
+NEARBY_MAX_RADIUS = 5000
+
+
+def parse_cafes_cursor(cursor):
+    # "<score_value>:<id>" of the last cafe on the previous page, "-" standing in for no score
+    try:
+        score, cafe_id = cursor.split(":")
+        return (None if score == "-" else int(score)), int(cafe_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor {cursor}")
+
+
+def parse_min_score(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        raise ValueError(f"Invalid min_score {value}")
+
+
+def parse_flag(name, value):
+    # ?open_now=1 / true / yes turns a filter on, 0 / false / no (or leaving it out) off
+    if value is None or value.lower() in ("", "0", "false", "no", "off"):
+        return False
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    raise ValueError(f"Invalid {name} {value}")
+
+
+def filter_cafes_query(borough, filters, min_score=None, cursor=None):
+    # Same order as the borough page: best score first, unscored cafes last
+    query = (
+        db.select(Cafe)
+        .where(Cafe.borough == borough, Cafe.reported_closed == "False")
+        .order_by(Cafe.score_value.desc().nulls_last(), Cafe.id)
+    )
+    if filters:
+        query = query.join(CafeCriteria, CafeCriteria.cafe_id == Cafe.id)
+    for key, level in filters.items():
+        # Asking for e.g. wifi=medium also matches "high"
+        query = query.where(getattr(CafeCriteria, key) >= CRITERIA_CODES[level])
+    if min_score is not None:
+        query = query.where(Cafe.score_value >= min_score)
+    if cursor is not None:
+        score, cafe_id = cursor
+        if score is None:
+            query = query.where(Cafe.score_value.is_(None), Cafe.id > cafe_id)
+        else:
+            query = query.where(
+                (Cafe.score_value < score)
+                | ((Cafe.score_value == score) & (Cafe.id > cafe_id))
+                | Cafe.score_value.is_(None)
+            )
+    return query
 
 
 def obtain_top_cafes():
     top_cafes = (
-        db.session.query(Cafe).order_by(cast(Cafe.score, Integer).desc()).limit(3).all()
+        db.session.query(Cafe)
+        .filter(Cafe.score_value.is_not(None))
+        .order_by(Cafe.score_value.desc())
+        .limit(3)
+        .all()
     )
     return top_cafes
 
 
+# Backups are gzipped newline-delimited JSON, one row per line, written and read a chunk of
+# rows at a time so memory stays flat however big the tables get
+BACKUP_CHUNK_SIZE = 1000
+# Password hashes are left out of backups. Users restored without one get this instead,
+# which no password matches
+UNUSABLE_PASSWORD = "!"
+
+
+def backup_tables():
+    # In restore order, so foreign keys always point at rows that are already there
+    return {
+        "users": User.__table__,
+        "cafes": Cafe.__table__,
+        "reviews": Review.__table__,
+        "user_cafe": user_cafe_association,
+    }
+
+
+def backup_rows(with_passwords=False):
+    for name, table in backup_tables().items():
+        columns = [
+            column
+            for column in table.columns
+            if with_passwords or not (name == "users" and column.name == "password")
+        ]
+        # yield_per fetches from a server-side cursor where the database has one
+        result = db.session.execute(
+            db.select(*columns)
+            .order_by(*table.primary_key.columns)
+            .execution_options(yield_per=BACKUP_CHUNK_SIZE)
+        )
+        yield name, (row._asdict() for row in result)
+
+
+def decode_backup_row(table, row):
+    values = {}
+    for column in table.columns:
+        if column.name not in row:
+            continue
+        value = row[column.name]
+        if isinstance(column.type, DateTime) and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        elif isinstance(column.type, Date) and isinstance(value, str):
+            value = date.fromisoformat(value)
+        values[column.name] = value
+    if table is User.__table__ and not values.get("password"):
+        values["password"] = UNUSABLE_PASSWORD
+    return values
+
+
+def reset_id_sequences(tables):
+    # Rows restored with their ids don't advance PostgreSQL's id sequences, so move them past
+    # the highest id. SQLite works the next id out from the table itself
+    if db.engine.dialect.name != "postgresql":
+        return
+    for table in tables:
+        if "id" in table.columns:
+            db.session.execute(
+                text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                    f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"
+                )
+            )
+
+
+def non_empty_backup_tables():
+    return [
+        name
+        for name, table in backup_tables().items()
+        if db.session.execute(db.select(table).limit(1)).first()
+    ]
+
+
+def clear_backup_tables():
+    # Children first, so no foreign key is left pointing at a deleted row. Boroughs are kept;
+    # they only hold slugs and are re-created from the restored cafes anyway
+    for table in (
+        user_cafe_association,
+        Review.__table__,
+        CafeCriteria.__table__,
+        Cafe.__table__,
+        User.__table__,
+    ):
+        db.session.execute(delete(table))
+    db.session.commit()
+
+
+def restore_rows(records):
+    # Restores into empty tables only: the backup's rows keep their ids, so any row already in
+    # the database (e.g. a user who registered after a reset) would have the backup's reviews
+    # and likes attached to it. Clear the tables first with clear_backup_tables()
+    non_empty = non_empty_backup_tables()
+    if non_empty:
+        raise ValueError(
+            f"Can't restore into tables that have rows: {', '.join(non_empty)}"
+        )
+    tables = backup_tables()
+    restored = Counter()
+    skipped = 0
+    for chunk in chunked(records, BACKUP_CHUNK_SIZE):
+        rows_by_table = {}
+        for name, row in chunk:
+            table = tables.get(name)
+            if table is None:
+                skipped += 1
+                continue
+            rows_by_table.setdefault(name, []).append(decode_backup_row(table, row))
+        for name, rows in rows_by_table.items():
+            db.session.execute(insert(tables[name]), rows)
+            if name == "cafes":
+                db.session.execute(
+                    insert(CafeCriteria),
+                    [
+                        {
+                            "cafe_id": row["id"],
+                            **encode_criteria(row.get("criterion") or {}),
+                        }
+                        for row in rows
+                    ],
+                )
+            restored[name] += len(rows)
+        db.session.commit()
+
+    if restored:
+        for (name,) in db.session.query(Cafe.borough).distinct():
+            get_or_create_borough(name)
+        db.session.execute(update(Borough).values(updated_at=utc_now()))
+        reset_id_sequences(tables.values())
+        db.session.commit()
+        # Restored reviews and likes weren't counted as they went in, and backups from
+        # before reviews had an updated_at only have their dates
+        reconcile_cafe_stats()
+        backfill_review_timestamps()
+        invalidate_caches()
+    return restored, skipped
+
+
 # ---------------------------------------------------ENV VARIABLES------------------------------------------------------------------------------------
 google_api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+# Comma-separated emails of the users allowed into /admin pages
+ADMIN_EMAILS = {
+    email.strip().lower()
+    for email in os.getenv("ADMIN_EMAILS", "").split(",")
+    if email.strip()
+}
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------------
 @app.context_processor
 def inject_globals():
-    return {"google_api_key": google_api_key}
+    return {"google_api_key": google_api_key, "srcset": srcset}
 
 
 @app.route("/favicon.ico")
@@ -385,65 +1216,118 @@ def favicon():
         os.path.join(app.root_path, "static"),
         "favicon.ico",
         mimetype="image/vnd.microsoft.icon",
+        max_age=IMAGE_MAX_AGE,
     )
 
 
 @app.route("/")
+@conditional_for_anonymous(
+    lambda: db.session.query(func.max(Borough.updated_at)).scalar()
+)
+@cache_page_for_anonymous
 def home():
     top_cafes = obtain_top_cafes()
-    return render_template("index.html", top_cafes=top_cafes, make_slug=make_slug)
+    return render_template("index.html", top_cafes=top_cafes)
 
 
 # Borough pages
 @app.route("/boroughs")
+@cache_page_for_anonymous
 def show_all_locations():
-    result = db.session.execute(db.select(Cafe))
-    cafes = result.scalars().all()
-    locations = [cafe.borough for cafe in cafes]
-    all_unique_locations = list(set(locations))  # set removes duplicates from our list
-    all_unique_locations.sort()  # sort alphabetically
-    return render_template(
-        "all-locations.html", borough_names=all_unique_locations, make_slug=make_slug
-    )
+    # Only lists boroughs that have at least one open cafe, sorted alphabetically
+    return render_template("all-locations.html", boroughs=get_borough_summary())
 
 
 @app.route("/boroughs/<location_slug>")
+@conditional_for_anonymous(
+    lambda location_slug: db.first_or_404(
+        db.select(Borough).filter_by(slug=location_slug)
+    ).updated_at
+)
+@cache_page_for_anonymous
 def show_location(location_slug):
-    location = make_slug_inverse(location_slug)
+    location = db.first_or_404(db.select(Borough).filter_by(slug=location_slug)).name
     lat = borough_coords[location]["lat"]
     lng = borough_coords[location]["lng"]
-    cafes_at_location = (
-        db.session.query(Cafe)
-        .filter_by(borough=location, reported_closed="False")
-        .all()
-    )
+    cafes_at_location, cafe_views = get_cafes_with_views(location)
 
-    current_day = datetime.now().strftime("%a")
+    current_day = london_now().strftime("%a")
     return render_template(
         "location.html",
-        all_cafes=sorted(
-            cafes_at_location, key=lambda cafe: cafe.get_numeric_score(), reverse=True
-        ),
+        all_cafes=cafes_at_location,
+        cafe_views=cafe_views,
         borough_lat=lat,
         borough_lng=lng,
         current_day=current_day,
-        make_slug=make_slug,
     )
 
 
 # Cafe pages
 @app.route("/cafes/<cafe_id>", methods=["GET", "POST"])
+@conditional_for_anonymous(lambda cafe_id: db.get_or_404(Cafe, cafe_id).updated_at)
+@cache_page_for_anonymous
 def show_cafe(cafe_id):
     edit_review = request.args.get("edit_review", "false")
     cafe_info = db.get_or_404(Cafe, cafe_id)
-    current_day = datetime.now().strftime("%a")
+    reviews, next_reviews = get_reviews_page(cafe_info.id)
+    user_review = None
+    cafe_view = CafeView("unknown", cafe_info.score)
+    if current_user.is_authenticated:
+        user_review = current_user.get_review_for_cafe(cafe_info.id)
+        like_level = current_user.get_like_level(cafe_info.id)
+        cafe_view = CafeView(like_level, like_level_score(cafe_info.score, like_level))
+    current_day = london_now().strftime("%a")
     return render_template(
         "cafe.html",
         cafe=cafe_info,
+        cafe_view=cafe_view,
+        reviews=reviews,
+        next_reviews=next_reviews,
+        user_review=user_review,
         current_day=current_day,
         edit_review=edit_review,
-        user_has_review_filter=user_has_review_filter,
-        make_slug=make_slug,
+    )
+
+
+@app.route("/cafes/<int:cafe_id>/reviews")
+def cafe_reviews(cafe_id):
+    # Further pages of reviews for the cafe page. Pass the previous page's "next" value as
+    # ?before=, e.g. /cafes/1/reviews?before=2026-10-18T08:33:11.378969_120
+    before = request.args.get("before")
+    try:
+        before = parse_reviews_cursor(before) if before else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = min(max(request.args.get("limit", REVIEWS_PER_PAGE, type=int), 1), 50)
+    reviews, next_reviews = get_reviews_page(cafe_id, before, limit)
+    user_id = current_user.id if current_user.is_authenticated else None
+    return jsonify(
+        {
+            "reviews": [
+                {
+                    "id": review.id,
+                    "date": review.date,
+                    "text": review.text,
+                    "author": (
+                        f"{review.author.name} {review.author.surname}"
+                        if review.author.privacy == "0"
+                        else "Anonymous"
+                    ),
+                    "photo_url": url_for(
+                        "static",
+                        filename=f"{PROFILE_PICS_DIR}/"
+                        + (
+                            review.author.photo_name
+                            if review.author.privacy == "0"
+                            else "anonymous.png"
+                        ),
+                    ),
+                    "is_own": review.author_id == user_id,
+                }
+                for review in reviews
+            ],
+            "next": next_reviews,
+        }
     )
 
 
@@ -451,7 +1335,8 @@ def show_cafe(cafe_id):
 def submit_review(cafe_id):
     if current_user.is_authenticated:
         cafe_info = db.get_or_404(Cafe, cafe_id)
-        current_date = datetime.now().strftime("%B %d, %Y")
+        today = london_now().date()
+        current_date = today.strftime(REVIEW_DATE_FORMAT)
 
         existing_review = (
             db.session.query(Review)
@@ -462,14 +1347,21 @@ def submit_review(cafe_id):
         if existing_review:
             existing_review.text = request.form.get("review[desc]")
             existing_review.date = str(current_date)
+            existing_review.updated_at = utc_now()
         else:
             new_review = Review(
                 text=request.form.get("review[desc]"),
                 author=current_user,
                 date=str(current_date),
+                updated_at=utc_now(),
                 parent_cafe=cafe_info,
             )
             db.session.add(new_review)
+        add_to_cafe_stats(
+            cafe_info.id,
+            {"review_count": 0 if existing_review else 1},
+            latest_review_on=today,
+        )
 
         association = (
             db.session.query(user_cafe_association)
@@ -482,11 +1374,12 @@ def submit_review(cafe_id):
                 user_id=current_user.id,
                 cafe_id=cafe_info.id,
                 like_level="unknown",
-                score=cafe_info.score,
             )
             db.session.execute(stmt)
 
+        touch_cafe(cafe_info)
         db.session.commit()
+        invalidate_caches()
     return redirect(url_for("show_cafe", cafe_id=cafe_info.id))
 
 
@@ -512,6 +1405,7 @@ def delete_review(cafe_id):
                 .first()
             )
 
+            deltas = Counter({"review_count": -1})
             if association:
                 db.session.execute(
                     user_cafe_association.delete().where(
@@ -519,8 +1413,14 @@ def delete_review(cafe_id):
                         & (user_cafe_association.c.cafe_id == cafe_info.id)
                     )
                 )
+                deltas.update(like_level_deltas(association.like_level, None))
 
+            add_to_cafe_stats(
+                cafe_info.id, deltas, latest_review_on=latest_review_on(cafe_info.id)
+            )
+            touch_cafe(cafe_info)
             db.session.commit()
+            invalidate_caches()
 
     return redirect(url_for("show_cafe", cafe_id=cafe_id))
 
@@ -529,16 +1429,16 @@ def delete_review(cafe_id):
 def report_closed(cafe_id):
     cafe = db.get_or_404(Cafe, cafe_id)
     cafe.reported_closed = "True"
+    touch_cafe(cafe)
     db.session.commit()
-    return redirect(url_for("show_location", location_slug=make_slug(cafe.borough)))
+    invalidate_caches()
+    return redirect(url_for("show_location", location_slug=cafe.borough_info.slug))
 
 
 @app.route("/cafes/<cafe_id>/<like_score>")
 def i_like_it(cafe_id, like_score):
     if current_user.is_authenticated:
         cafe = db.get_or_404(Cafe, cafe_id)
-        criterion = dict(cafe.criterion)
-        score = calculate_score(criterion, like_score)
 
         # Check if the association exists
         association = (
@@ -551,52 +1451,41 @@ def i_like_it(cafe_id, like_score):
             # Update the like_level if the association exists
             db.session.query(user_cafe_association).filter_by(
                 user_id=current_user.id, cafe_id=cafe.id
-            ).update({"like_level": like_score, "score": score})
+            ).update({"like_level": like_score})
         else:
             # Add the cafe to the user's visited cafes with the like_level if the association does not exist
             stmt = user_cafe_association.insert().values(
                 user_id=current_user.id,
                 cafe_id=cafe.id,
                 like_level=like_score,
-                score=score,
             )
             db.session.execute(stmt)
 
+        # Listings show the like counts, so they change with them
+        add_to_cafe_stats(
+            cafe.id,
+            like_level_deltas(
+                association.like_level if association else None, like_score
+            ),
+        )
+        touch_cafe(cafe)
         db.session.commit()
+        invalidate_caches()
     return redirect(url_for("show_cafe", cafe_id=cafe_id))
 
 
 @app.route("/cafes/<cafe_id>/edit", methods=["GET", "POST"])
 def edit(cafe_id):
     cafe = db.get_or_404(Cafe, cafe_id)
-    cafe_name = make_slug(cafe.name)
     if request.method == "POST":
         like_level = request.form.get("criterion[i_like_it]")
-        cafe.criterion = {
-            "wifi": request.form.get("criterion[wifi]"),
-            "sockets": request.form.get("criterion[sockets]"),
-            "long_stay": request.form.get("criterion[long_stay]"),
-            "tables": request.form.get("criterion[tables]"),
-            "quiet": request.form.get("criterion[quiet]"),
-            "calls": request.form.get("criterion[calls]"),
-            "vibe": request.form.get("criterion[vibe]"),
-            "groups": request.form.get("criterion[groups]"),
-            "coffee": request.form.get("criterion[coffee]"),
-            "food": request.form.get("criterion[food]"),
-            "veggie": request.form.get("criterion[veggie]"),
-            "alcohol": request.form.get("criterion[alcohol]"),
-            "credit_cards": request.form.get("criterion[credit_cards]"),
-            "light": request.form.get("criterion[light]"),
-            "outdoor": request.form.get("criterion[outdoor]"),
-            "spacious": request.form.get("criterion[spacious]"),
-            "toilets": request.form.get("criterion[toilets]"),
-            "access": request.form.get("criterion[access]"),
-            "ac": request.form.get("criterion[ac]"),
-            "pets": request.form.get("criterion[pets]"),
-            "parking": request.form.get("criterion[parking]"),
-        }
-        cafe.score = calculate_score(cafe.criterion, "unknown")
+        cafe.set_criterion(
+            {key: request.form.get(f"criterion[{key}]") for key in CRITERIA}
+        )
+        cafe.set_score(calculate_score(cafe.criterion, "unknown"))
+        touch_cafe(cafe)
         db.session.commit()
+        invalidate_caches()
         return redirect(
             url_for(
                 "show_cafe",
@@ -614,30 +1503,73 @@ def suggest():
 
 @app.route("/suggests", methods=["GET", "POST"])
 def suggests():
-    if request.method == "POST":
-        place_id = request.form.get("place[google_place_gid]")
-        place_name = request.form.get("place[name]")
-        lat = request.form.get("place[location][lat]")
-        lng = request.form.get("place[location][lng]")
-        borough = find_borough(lat, lng, boroughs_data)
-
-        new_cafe = Cafe(
-            place_id=place_id,
-            name=place_name,
-            address=request.form.get("place[location][address]"),
-            postal_code=request.form.get("place[location][postal_code]"),
-            borough=borough,
-            img_url=request.form.get("place[img_url]"),
-            map_url=f"https://www.google.com/maps/place/?q=place_id:{place_id}",
-            lat=lat,
-            lng=lng,
-            opening_hours=format_opening_hours(request.form.get("place[weekday_text]")),
-        )
+    place_id = request.form.get("place[google_place_gid]")
+    if request.method != "POST" or not place_id:
+        return redirect(url_for("suggest"))
+    # Suggesting a place that's already listed goes to the existing cafe instead of adding it again
+    if place_index.get(place_id):
+        existing = redirect_to_suggested_cafe(place_id)
+        if existing:
+            return existing
+
+    place_name = request.form.get("place[name]")
+    lat = request.form.get("place[location][lat]")
+    lng = request.form.get("place[location][lng]")
+    borough = find_borough(lat, lng)
+    img_url = request.form.get("place[img_url]")
+    photo_url = request.form.get("place[photo_url]")
+    if not (photo_url and photo_url.startswith(("https://", "http://"))):
+        photo_url = None
+    if photo_url:
+        # Only the chosen photo is downloaded, once the suggestion is submitted
+        relative_path = thumbnail_path(place_id, place_name)
+        img_url = url_for("static", filename=relative_path)
+
+    new_cafe = Cafe(
+        place_id=place_id,
+        name=place_name,
+        slug=slugify(place_name),
+        address=request.form.get("place[location][address]"),
+        postal_code=request.form.get("place[location][postal_code]"),
+        borough=borough,
+        img_url=img_url,
+        map_url=f"https://www.google.com/maps/place/?q=place_id:{place_id}",
+        lat=lat,
+        lng=lng,
+        opening_hours=format_opening_hours(request.form.get("place[weekday_text]")),
+    )
+    new_cafe.opening_intervals = opening_intervals(new_cafe.opening_hours)
+    new_cafe.set_criterion({})
+    try:
         db.session.add(new_cafe)
+        get_or_create_borough(borough)
+        touch_cafe(new_cafe)
         db.session.commit()
-        new_cafe_id = new_cafe.id
-        create_slug(place_name)
-        create_slug(borough)
+    except IntegrityError:
+        # Added by another request in the meantime (e.g. in a worker whose place index hadn't
+        # caught up yet), so the unique place_id turned this insert down
+        db.session.rollback()
+        existing = redirect_to_suggested_cafe(place_id)
+        if existing is None:
+            raise
+        place_index.add(place_id, load_place_summary(place_id))
+        return existing
+    invalidate_caches()
+    new_cafe_id = new_cafe.id
+    place_index.add(
+        place_id,
+        {
+            "id": new_cafe_id,
+            "location_slug": slugify(borough),
+            "cafe_slug": new_cafe.slug,
+        },
+    )
+    if photo_url:
+        image_jobs.submit(
+            photo_url,
+            os.path.join(app.static_folder, relative_path),
+            then=partial(store_cafe_variants, new_cafe_id),
+        )
     return redirect(url_for("under_review", cafe_id=new_cafe_id))
 
 
@@ -646,31 +1578,13 @@ def under_review(cafe_id):
     cafe = db.get_or_404(Cafe, cafe_id)
     if request.method == "POST":
         like_level = request.form.get("criterion[i_like_it]")
-        cafe.criterion = {
-            "wifi": request.form.get("criterion[wifi]"),
-            "sockets": request.form.get("criterion[sockets]"),
-            "long_stay": request.form.get("criterion[long_stay]"),
-            "tables": request.form.get("criterion[tables]"),
-            "quiet": request.form.get("criterion[quiet]"),
-            "calls": request.form.get("criterion[calls]"),
-            "vibe": request.form.get("criterion[vibe]"),
-            "groups": request.form.get("criterion[groups]"),
-            "coffee": request.form.get("criterion[coffee]"),
-            "food": request.form.get("criterion[food]"),
-            "veggie": request.form.get("criterion[veggie]"),
-            "alcohol": request.form.get("criterion[alcohol]"),
-            "credit_cards": request.form.get("criterion[credit_cards]"),
-            "light": request.form.get("criterion[light]"),
-            "outdoor": request.form.get("criterion[outdoor]"),
-            "spacious": request.form.get("criterion[spacious]"),
-            "toilets": request.form.get("criterion[toilets]"),
-            "access": request.form.get("criterion[access]"),
-            "ac": request.form.get("criterion[ac]"),
-            "pets": request.form.get("criterion[pets]"),
-            "parking": request.form.get("criterion[parking]"),
-        }
-        cafe.score = calculate_score(cafe.criterion, "unknown")
+        cafe.set_criterion(
+            {key: request.form.get(f"criterion[{key}]") for key in CRITERIA}
+        )
+        cafe.set_score(calculate_score(cafe.criterion, "unknown"))
+        touch_cafe(cafe)
         db.session.commit()
+        invalidate_caches()
         return redirect(
             url_for(
                 "show_cafe",
@@ -697,13 +1611,19 @@ def users():
             user.privacy = "0"
         profile_pic = request.files["user[avatar]"]
         if profile_pic:
-            filename = profile_pic.filename
-            file_path = os.path.join("static/assets/images/profile-pics", filename)
+            filename = secure_filename(profile_pic.filename)
+            file_path = os.path.join(app.static_folder, PROFILE_PICS_DIR, filename)
             profile_pic.save(file_path)
             user.photo_name = filename
+            user.photo_variants = None
+        touch_reviewed_cafes(user.id)
         db.session.commit()
+        invalidate_caches()
+        if profile_pic:
+            # Resized off the request; until then pages show the uploaded file
+            image_jobs.run(store_user_variants, user.id, file_path)
         return redirect(url_for("users"))
-    return render_template("users.html", make_slug=make_slug)
+    return render_template("users.html")
 
 
 @app.route("/users/login", methods=["GET", "POST"])
@@ -775,25 +1695,70 @@ def logout():
     return redirect(url_for("home"))
 
 
-## Other routes
-# Downloading cafe thumbnails
-@app.route("/download_image", methods=["POST"])
-def download_image_endpoint():
-    data = request.json
-    url = data.get("url")
-    image_name = re.sub(r"[^a-z0-9-]", "", data.get("name").lower().replace(" ", "-"))
-    save_path = os.path.join(
-        "static", "assets", "images", "thumbnails", f'{data.get("id")}-{image_name}.jpg'
+## Search
+@app.route("/search")
+def search():
+    # e.g. /search?q=quiet+wifi+hackney
+    query = request.args.get("q", "").strip()[:200]
+    results = search_cafes(query) if query else []
+    return render_template(
+        "search.html",
+        query=query,
+        results=results,
+        current_day=london_now().strftime("%a"),
+    )
+
+
+@app.route("/api/search")
+def search_api():
+    query = request.args.get("q", "").strip()[:200]
+    started = time.perf_counter()
+    results = search_cafes(query) if query else []
+    return jsonify(
+        {
+            "query": query,
+            "results": [
+                {
+                    "id": cafe.id,
+                    "name": cafe.name,
+                    "borough": cafe.borough,
+                    "score": cafe.score,
+                    "url": url_for("show_cafe", cafe_id=cafe.id),
+                    # HTML, with the matched words in <mark>
+                    "snippet": str(snippet),
+                }
+                for cafe, snippet in results
+            ],
+            "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
     )
-    result = download_image(url, save_path)
 
-    # Construct the URL relative to the static folder
-    relative_path = os.path.join(
-        "assets", "images", "thumbnails", f'{data.get("id")}-{image_name}.jpg'
-    ).replace("\\", "/")
-    img_url = url_for("static", filename=relative_path)
 
-    return jsonify({"message": result, "path": img_url})
+## Other routes
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return redirect(url_for("log_in"))
+        if current_user.email.lower() not in ADMIN_EMAILS:
+            abort(403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+# Downloads a backup of the database, gzipped as it is streamed. Restore it with flask restore
+@app.route("/admin/backup")
+@admin_required
+def admin_backup():
+    filename = f"borough-brews-{utc_now():%Y%m%d-%H%M%S}.ndjson.gz"
+    response = app.response_class(
+        stream_with_context(gzip_stream(backup_lines(backup_rows()))),
+        mimetype="application/gzip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+    response.cache_control.no_store = True
+    return response
 
 
 @app.route("/api/check_cafe")
@@ -803,5 +1768,650 @@ def check_cafe():
     return jsonify(result)
 
 
+@app.route("/api/boroughs/<location_slug>/cafes")
+def borough_cafes_api(location_slug):
+    # e.g. /api/boroughs/hackney/cafes?wifi=high&sockets=medium&min_score=60&open_now=1&limit=20
+    # Pass the returned "next" value back as ?cursor= for the following page
+    borough = db.first_or_404(db.select(Borough).filter_by(slug=location_slug))
+    try:
+        filters = {}
+        for key, level in request.args.items():
+            if key in ("min_score", "open_now", "limit", "cursor"):
+                continue
+            if key not in CRITERIA or not CRITERIA_CODES.get(level):
+                raise ValueError(f"Unknown filter {key}={level}")
+            filters[key] = level
+        min_score = parse_min_score(request.args.get("min_score"))
+        open_now = parse_flag("open_now", request.args.get("open_now"))
+        limit = min(max(request.args.get("limit", CAFES_API_LIMIT, type=int), 1), 100)
+        cursor = request.args.get("cursor")
+        cursor = parse_cafes_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query = filter_cafes_query(borough.name, filters, min_score, cursor)
+    if open_now:
+        # One pass over the borough's opening intervals, then the rest stays in SQL
+        now = london_now()
+        open_ids = [
+            cafe_id
+            for cafe_id, intervals in db.session.execute(
+                db.select(Cafe.id, Cafe.opening_intervals).where(
+                    Cafe.borough == borough.name, Cafe.reported_closed == "False"
+                )
+            )
+            if is_open_at(intervals, now)
+        ]
+        query = query.where(Cafe.id.in_(open_ids))
+    cafes = db.session.execute(query.limit(limit + 1)).scalars().all()
+
+    next_cursor = None
+    if len(cafes) > limit:
+        cafes = cafes[:limit]
+        last = cafes[-1]
+        score = "-" if last.score_value is None else last.score_value
+        next_cursor = f"{score}:{last.id}"
+    return jsonify(
+        {
+            "cafes": [
+                {
+                    "id": cafe.id,
+                    "name": cafe.name,
+                    "slug": cafe.slug,
+                    "url": url_for("show_cafe", cafe_id=cafe.id),
+                    "img_url": cafe.img_url,
+                    "address": cafe.address,
+                    "lat": cafe.lat,
+                    "lng": cafe.lng,
+                    "score": cafe.score,
+                    "review_count": cafe.review_count or 0,
+                    "like_count": cafe.like_count,
+                    "like_average": cafe.like_average,
+                    "criterion": {key: cafe.criterion.get(key) for key in filters},
+                }
+                for cafe in cafes
+            ],
+            "next": next_cursor,
+        }
+    )
+
+
+@app.route("/api/cafes/nearby")
+def nearby_cafes_api():
+    # e.g. /api/cafes/nearby?lat=51.5160&lng=-0.0632&radius=800&limit=10, radius in metres.
+    # Not limited to one borough, so cafes just over a borough boundary are found too
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({"error": "lat and lng are required"}), 400
+    radius = request.args.get("radius", NEARBY_RADIUS, type=float)
+    if not math.isfinite(radius):
+        return jsonify({"error": "radius must be a number of metres"}), 400
+    radius = min(max(radius, 0), NEARBY_MAX_RADIUS)
+    limit = min(max(request.args.get("limit", CAFES_API_LIMIT, type=int), 1), 100)
+
+    nearest = get_cafe_grid().nearby(lat, lng, radius, limit)
+    cafes = {
+        cafe.id: cafe
+        for cafe in db.session.execute(
+            db.select(Cafe).where(Cafe.id.in_([cafe_id for cafe_id, _ in nearest]))
+        ).scalars()
+    }
+    return jsonify(
+        {
+            "cafes": [
+                {
+                    "id": cafe_id,
+                    "name": cafes[cafe_id].name,
+                    "slug": cafes[cafe_id].slug,
+                    "url": url_for("show_cafe", cafe_id=cafe_id),
+                    "img_url": cafes[cafe_id].img_url,
+                    "address": cafes[cafe_id].address,
+                    "borough": cafes[cafe_id].borough,
+                    "lat": cafes[cafe_id].lat,
+                    "lng": cafes[cafe_id].lng,
+                    "score": cafes[cafe_id].score,
+                    "distance": round(distance),
+                }
+                for cafe_id, distance in nearest
+                # Skips a cafe removed since the grid was built
+                if cafe_id in cafes
+            ]
+        }
+    )
+
+
+# ---------------------------------------------------CLI COMMANDS------------------------------------------------------------------------------------
+# Run with e.g. `flask --app main reclassify-boroughs`
+@app.cli.command("reclassify-boroughs")
+def reclassify_boroughs():
+    cafes = db.session.query(Cafe.id, Cafe.lat, Cafe.lng, Cafe.borough).all()
+    boroughs = find_boroughs([cafe.lat for cafe in cafes], [cafe.lng for cafe in cafes])
+    now = utc_now()
+    # A point that falls outside every polygon keeps the borough it already has
+    moved = [
+        (cafe, borough)
+        for cafe, borough in zip(cafes, boroughs)
+        if borough != "N/A" and borough != cafe.borough
+    ]
+    if moved:
+        db.session.execute(
+            update(Cafe),
+            [
+                {"id": cafe.id, "borough": borough, "updated_at": now}
+                for cafe, borough in moved
+            ],
+        )
+        # Both the borough a cafe left and the one it joined list different cafes now
+        names = {cafe.borough for cafe, _ in moved} | {borough for _, borough in moved}
+        for name in names:
+            get_or_create_borough(name)
+        db.session.flush()
+        db.session.execute(
+            update(Borough).where(Borough.name.in_(names)).values(updated_at=now)
+        )
+        db.session.commit()
+        invalidate_caches()
+    print(f"Re-classified {len(moved)} of {len(cafes)} cafes")
+
+
+# Re-run whenever static/geojson/london_boroughs.geojson changes
+@app.cli.command("build-boroughs-cache")
+def build_boroughs_cache_command():
+    boroughs_data = build_boroughs_cache()
+    print(f"Cached {len(boroughs_data.names)} borough polygons")
+
+
+# Re-run after changing the weights in static/utils/score_utils.py. With --check it only
+# compares the results against calculate_score for every cafe and like, without writing
+RESCORE_CHUNK_SIZE = 1000
+
+
+@app.cli.command("rescore")
+@click.option("--check", is_flag=True)
+def rescore(check):
+    # Cafes that have never been rated keep their "XX"
+    cafes = [
+        cafe
+        for cafe in db.session.execute(
+            db.select(Cafe.id, Cafe.criterion, Cafe.score).order_by(Cafe.id)
+        ).all()
+        if cafe.criterion
+    ]
+    scores, unknown = base_scores([cafe.criterion for cafe in cafes], CRITERIA)
+    cafe_scores = format_scores(scores, unknown)
+
+    if check:
+        # Users' scores are derived from the cafe's score by like_level_score(), so check
+        # that path against calculate_score for every like too
+        rated = {cafe.id: (cafe, score) for cafe, score in zip(cafes, cafe_scores)}
+        association = user_cafe_association.c
+        likes = [
+            like
+            for like in db.session.execute(
+                db.select(
+                    association.user_id, association.cafe_id, association.like_level
+                )
+            ).all()
+            if like.cafe_id in rated
+        ]
+        mismatches = [
+            cafe.id
+            for cafe, score in zip(cafes, cafe_scores)
+            if calculate_score(cafe.criterion, "unknown") != score
+        ] + [
+            (like.user_id, like.cafe_id)
+            for like in likes
+            if calculate_score(rated[like.cafe_id][0].criterion, like.like_level)
+            != like_level_score(rated[like.cafe_id][1], like.like_level)
+        ]
+        print(
+            f"Checked {len(cafes)} cafes and {len(likes)} likes: "
+            f"{len(mismatches)} mismatches {mismatches[:20]}"
+        )
+        if mismatches:
+            raise SystemExit(1)
+        return
+
+    now = utc_now()
+    cafe_changes = [
+        {
+            "id": cafe.id,
+            "updated_at": now,
+            "score": score,
+            "score_value": None if score == "XX" else int(score),
+        }
+        for cafe, score in zip(cafes, cafe_scores)
+        if score != cafe.score
+    ]
+    for start in range(0, len(cafe_changes), RESCORE_CHUNK_SIZE):
+        db.session.execute(
+            update(Cafe), cafe_changes[start : start + RESCORE_CHUNK_SIZE]
+        )
+    if cafe_changes:
+        db.session.execute(update(Borough).values(updated_at=now))
+        db.session.commit()
+        invalidate_caches()
+    print(f"Rescored {len(cafe_changes)} of {len(cafes)} cafes")
+
+
+# Makes the resized variants for thumbnails and profile pictures that don't have them yet
+@app.cli.command("build-image-variants")
+def build_image_variants():
+    static_url = app.static_url_path + "/"
+    cafes = db.session.execute(
+        db.select(Cafe.id, Cafe.img_url).where(Cafe.img_variants.is_(None))
+    ).all()
+    built = 0
+    for cafe_id, img_url in cafes:
+        source_path = os.path.join(app.static_folder, img_url[len(static_url) :])
+        if img_url.startswith(static_url) and os.path.isfile(source_path):
+            store_cafe_variants(cafe_id, source_path)
+            built += 1
+    print(f"Built variants for {built} of {len(cafes)} cafe thumbnails")
+
+    users = db.session.execute(
+        db.select(User.id, User.photo_name).where(
+            User.photo_variants.is_(None), User.photo_name != "anonymous.png"
+        )
+    ).all()
+    built = 0
+    for user_id, photo_name in users:
+        source_path = os.path.join(app.static_folder, PROFILE_PICS_DIR, photo_name)
+        if os.path.isfile(source_path):
+            store_user_variants(user_id, source_path)
+            built += 1
+    print(f"Built variants for {built} of {len(users)} profile pictures")
+
+
+# Fingerprints the static assets and writes their gzip (and, with the brotli package installed,
+# Brotli) copies and manifest to static/dist. Run on every deploy, before the app starts
+@app.cli.command("build-assets")
+def build_assets():
+    manifest = build_asset_manifest(
+        app.static_folder,
+        skip_dirs=("utils", "geojson", THUMBNAILS_DIR, PROFILE_PICS_DIR, VARIANTS_DIR),
+    )
+    compressed = sum(1 for asset in manifest.values() if asset["encodings"])
+    print(f"Fingerprinted {len(manifest)} static assets, {compressed} pre-compressed")
+
+
+# Adds the cafes in a CSV or JSON lines export of places (see static/utils/import_utils.py),
+# e.g. to seed a new area. Rows are read, classified and inserted a chunk at a time, so memory
+# stays flat however big the file. Places already in the database or outside London are skipped
+IMPORT_CHUNK_SIZE = 1000
+PLACEHOLDER_IMAGE = "assets/gray-place-d2bdb4477600e061c01bd816cc0f2ef0cfcb1ca9e3ad78868dd16fb2af073a21.png"
+
+
+@app.cli.command("import-cafes")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True)
+@click.option(
+    "--download-photos", is_flag=True, help="Download each row's photo_url locally"
+)
+def import_cafes(path, chunk_size, download_photos):
+    started = time.perf_counter()
+    place_ids = set(db.session.scalars(db.select(Cafe.place_id)))
+    borough_names = set(db.session.scalars(db.select(Borough.name)))
+    read = imported = skipped = 0
+    downloads = 0
+
+    for chunk in chunked(read_places(path), chunk_size):
+        places = []
+        for row_number, record in enumerate(chunk, start=read + 1):
+            try:
+                place = normalize_place(record)
+            except ValueError as e:
+                print(f"Skipping row {row_number}: {e}")
+                skipped += 1
+                continue
+            # Also catches places listed twice in the same file
+            if place["place_id"] in place_ids:
+                skipped += 1
+                continue
+            place_ids.add(place["place_id"])
+            places.append(place)
+        read += len(chunk)
+
+        boroughs = find_boroughs(
+            [place["lat"] for place in places], [place["lng"] for place in places]
+        )
+        now = utc_now()
+        rows = []
+        photos = []
+        for place, borough in zip(places, boroughs):
+            if borough == "N/A":
+                print(f"Skipping {place['name']}: not in a London borough")
+                skipped += 1
+                continue
+            img_url = (
+                place["img_url"]
+                or place["photo_url"]
+                or f"{app.static_url_path}/{PLACEHOLDER_IMAGE}"
+            )
+            if download_photos and place["photo_url"]:
+                relative_path = thumbnail_path(place["place_id"], place["name"])
+                img_url = f"{app.static_url_path}/{relative_path}"
+                photos.append((len(rows), place["photo_url"], relative_path))
+            opening_hours = format_opening_hours(place["weekday_text"])
+            rows.append(
+                {
+                    "place_id": place["place_id"],
+                    "name": place["name"],
+                    "slug": slugify(place["name"]),
+                    "address": place["address"],
+                    "postal_code": place["postal_code"],
+                    "borough": borough,
+                    "img_url": img_url,
+                    "map_url": f"https://www.google.com/maps/place/?q=place_id:{place['place_id']}",
+                    "lat": place["lat"],
+                    "lng": place["lng"],
+                    "opening_hours": opening_hours,
+                    "opening_intervals": opening_intervals(opening_hours),
+                    "criterion": {},
+                    "updated_at": now,
+                }
+            )
+        if not rows:
+            continue
+
+        cafe_ids = db.session.scalars(
+            insert(Cafe).returning(Cafe.id, sort_by_parameter_order=True), rows
+        ).all()
+        db.session.execute(
+            insert(CafeCriteria),
+            [{"cafe_id": cafe_id, **encode_criteria({})} for cafe_id in cafe_ids],
+        )
+        chunk_boroughs = {row["borough"] for row in rows}
+        for name in chunk_boroughs - borough_names:
+            get_or_create_borough(name)
+        borough_names |= chunk_boroughs
+        db.session.execute(
+            update(Borough)
+            .where(Borough.name.in_(chunk_boroughs))
+            .values(updated_at=now)
+        )
+        db.session.commit()
+        imported += len(rows)
+
+        for index, photo_url, relative_path in photos:
+            image_jobs.submit(
+                photo_url,
+                os.path.join(app.static_folder, relative_path),
+                then=partial(store_cafe_variants, cafe_ids[index]),
+            )
+        downloads += len(photos)
+        print(
+            f"Imported {imported} cafes from {read} rows "
+            f"({read / (time.perf_counter() - started):.0f} rows/sec)"
+        )
+
+    if imported:
+        invalidate_caches()
+    elapsed = time.perf_counter() - started
+    print(
+        f"Imported {imported} of {read} rows ({skipped} skipped) in {elapsed:.1f}s, "
+        f"{read / elapsed if elapsed else 0:.0f} rows/sec"
+    )
+    if downloads:
+        print(f"Waiting for {downloads} photo downloads...")
+        image_jobs.executor.shutdown(wait=True)
+
+
+# Writes users (without password hashes unless --with-passwords), cafes, reviews and likes to a
+# gzipped newline-delimited JSON file, by default backups/borough-brews-<time>.ndjson.gz
+@app.cli.command("backup")
+@click.argument("path", required=False)
+@click.option(
+    "--with-passwords", is_flag=True, help="Include password hashes, so logins survive"
+)
+def backup(path, with_passwords):
+    started = time.perf_counter()
+    path = path or os.path.join(
+        "backups", f"borough-brews-{utc_now():%Y%m%d-%H%M%S}.ndjson.gz"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    count = write_backup(path, backup_lines(backup_rows(with_passwords)))
+    print(f"Backed up {count} rows to {path} in {time.perf_counter() - started:.1f}s")
+
+
+# Adds the rows of a backup made by flask backup or /admin/backup that aren't in the database
+@app.cli.command("restore")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Delete every user, cafe, review and like first, then restore",
+)
+def restore(path, force):
+    started = time.perf_counter()
+    if force:
+        clear_backup_tables()
+    try:
+        restored, skipped = restore_rows(read_backup(path))
+    except ValueError as e:
+        print(
+            f"{e}. Restore into an empty database, or pass --force to replace its data"
+        )
+        raise SystemExit(1)
+    print(
+        f"Restored {dict(restored)} ({skipped} rows from unknown tables skipped) "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+# Recounts every cafe's review and like counters from the reviews and user_cafe tables and
+# fixes any that have drifted. Run it periodically (e.g. nightly from a scheduler); with
+# --check it only reports the drift
+STATS_CHUNK_SIZE = 1000
+
+
+def recount_cafe_stats():
+    stats = {
+        cafe_id: {**dict.fromkeys(CAFE_STATS_COLUMNS, 0), "latest_review_on": None}
+        for cafe_id in db.session.scalars(db.select(Cafe.id))
+    }
+    for cafe_id, review_date in db.session.execute(
+        db.select(Review.cafe_id, Review.date)
+    ):
+        if cafe_id in stats:
+            cafe_stats = stats[cafe_id]
+            cafe_stats["review_count"] += 1
+            reviewed_on = parse_review_date(review_date)
+            if reviewed_on and (
+                cafe_stats["latest_review_on"] is None
+                or reviewed_on > cafe_stats["latest_review_on"]
+            ):
+                cafe_stats["latest_review_on"] = reviewed_on
+    association = user_cafe_association.c
+    for cafe_id, like_level, count in db.session.execute(
+        db.select(association.cafe_id, association.like_level, func.count()).group_by(
+            association.cafe_id, association.like_level
+        )
+    ):
+        if cafe_id in stats and like_level in LIKE_LEVEL_COLUMNS:
+            stats[cafe_id][LIKE_LEVEL_COLUMNS[like_level]] = count
+    return stats
+
+
+def reconcile_cafe_stats(check=False):
+    stats = recount_cafe_stats()
+    columns = [getattr(Cafe, column) for column in CAFE_STATS_COLUMNS]
+    changes = [
+        {"id": cafe.id, **stats[cafe.id]}
+        for cafe in db.session.execute(db.select(Cafe.id, *columns))
+        if any(
+            getattr(cafe, column) != stats[cafe.id][column]
+            for column in CAFE_STATS_COLUMNS
+        )
+    ]
+    if changes and not check:
+        now = utc_now()
+        for start in range(0, len(changes), STATS_CHUNK_SIZE):
+            db.session.execute(
+                update(Cafe),
+                [
+                    {**change, "updated_at": now}
+                    for change in changes[start : start + STATS_CHUNK_SIZE]
+                ],
+            )
+        db.session.execute(update(Borough).values(updated_at=now))
+        db.session.commit()
+        invalidate_caches()
+    return changes, len(stats)
+
+
+@app.cli.command("reconcile-cafe-stats")
+@click.option("--check", is_flag=True)
+def reconcile_cafe_stats_command(check):
+    changes, checked = reconcile_cafe_stats(check)
+    print(
+        f"{'Found' if check else 'Fixed'} drifted stats on {len(changes)} of {checked} cafes "
+        f"{[change['id'] for change in changes[:20]]}"
+    )
+    if check and changes:
+        raise SystemExit(1)
+
+
+# ---------------------------------------------------MIGRATIONS------------------------------------------------------------------------------------
+def add_missing_columns():
+    # db.create_all() only creates missing tables, so columns added to an existing model
+    # need an ALTER TABLE (they are all nullable) before the app can query them
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = [column["name"] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+                added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def create_missing_indexes():
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = [index["name"] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+
+def remove_duplicate_reviews():
+    # The unique (author_id, cafe_id) index can't be built while a user still has two reviews
+    # of the same cafe, so keep only their newest one
+    newest = db.select(func.max(Review.id)).group_by(Review.author_id, Review.cafe_id)
+    result = db.session.execute(
+        delete(Review).where(Review.id.not_in(newest)),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def backfill_slugs():
+    cafes = db.session.query(Cafe).filter(Cafe.slug.is_(None)).all()
+    # Keep any slug already handed out through data/slugged_names.json
+    slugged_names = load_slugged_names(SLUGGED_NAMES_PATH) if cafes else {}
+    for cafe in cafes:
+        cafe.slug = slugged_names.get(cafe.name) or slugify(cafe.name)
+    for (name,) in db.session.query(Cafe.borough).distinct():
+        get_or_create_borough(name)
+    db.session.commit()
+    return len(cafes)
+
+
+def backfill_cafe_criteria():
+    missing = db.session.execute(
+        db.select(Cafe.id, Cafe.criterion)
+        .outerjoin(CafeCriteria, CafeCriteria.cafe_id == Cafe.id)
+        .where(CafeCriteria.cafe_id.is_(None))
+    ).all()
+    if missing:
+        db.session.execute(
+            insert(CafeCriteria),
+            [
+                {"cafe_id": cafe_id, **encode_criteria(criterion or {})}
+                for cafe_id, criterion in missing
+            ],
+        )
+        db.session.commit()
+    return len(missing)
+
+
+def backfill_opening_intervals():
+    cafes = db.session.execute(
+        db.select(Cafe.id, Cafe.opening_hours).where(Cafe.opening_intervals.is_(None))
+    ).all()
+    if cafes:
+        db.session.execute(
+            update(Cafe),
+            [
+                {"id": cafe_id, "opening_intervals": opening_intervals(opening_hours)}
+                for cafe_id, opening_hours in cafes
+            ],
+        )
+        db.session.commit()
+    return len(cafes)
+
+
+def backfill_score_values():
+    result = db.session.execute(
+        update(Cafe)
+        .where(Cafe.score != "XX", Cafe.score_value.is_(None))
+        .values(score_value=cast(Cafe.score, Integer))
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def backfill_review_timestamps():
+    # Reviews from before updated_at only have their display date, so they are placed at
+    # the start of that day; ids keep same-day reviews in the order they were written
+    changes = []
+    for review_id, review_date in db.session.execute(
+        db.select(Review.id, Review.date).where(Review.updated_at.is_(None))
+    ):
+        reviewed_on = parse_review_date(review_date)
+        if reviewed_on:
+            changes.append(
+                {
+                    "id": review_id,
+                    "updated_at": datetime.combine(reviewed_on, datetime.min.time()),
+                }
+            )
+    for start in range(0, len(changes), STATS_CHUNK_SIZE):
+        db.session.execute(update(Review), changes[start : start + STATS_CHUNK_SIZE])
+    db.session.commit()
+    return len(changes)
+
+
+# Safe to re-run: brings an existing database up to date with the models and fills in new columns
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    for column in add_missing_columns():
+        print(f"Added column {column}")
+    print(f"Removed {remove_duplicate_reviews()} duplicate reviews")
+    for index in create_missing_indexes():
+        print(f"Created index {index}")
+    print(f"Backfilled {backfill_slugs()} cafe slugs")
+    print(f"Backfilled {backfill_score_values()} cafe score values")
+    print(f"Backfilled {backfill_cafe_criteria()} cafe criteria rows")
+    print(f"Backfilled {backfill_opening_intervals()} cafe opening intervals")
+    print(f"Backfilled {backfill_review_timestamps()} review timestamps")
+    print(
+        f"Backfilled review and like counts of {len(reconcile_cafe_stats()[0])} cafes"
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=5003)
@@ -57,32 +57,13 @@ function getTextBeforeLondonPostcode(address) {
     }
 }
 
-var savePath;
-
-function downloadImage(url, name, id) {
-    fetch('/download_image', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ url: url, name: name, id: id })
-    })
-    .then(response => response.json())
-    .then(data => {
-        savePath = data.path;
-        console.log(data.message);
-        console.log("Save Path:", savePath);
-
-        // Update the hidden input element with the new save path
-        var inputElement = document.getElementById('place_img_url');
-        if (inputElement) {
-            inputElement.value = savePath;
-            console.log('Changed thumbnail input value');
-        }
-    })
-    .catch(error => {
-        console.error('Error:', error);
-    });
+// Remember the chosen photo; the server downloads it when the suggestion is submitted
+function choosePhoto(url) {
+    var inputElement = document.getElementById('place_photo_url');
+    if (inputElement) {
+        inputElement.value = url;
+        console.log('Changed thumbnail input value');
+    }
 }
 
 // Initialize a global variable to store the place name
@@ -229,7 +210,7 @@ function initMap() {
         }
         thumbnailDiv.classList.add('selected');
         console.log("Selected photo:", photoUrl);
-        downloadImage(photoUrl, name, id);
+        choosePhoto(photoUrl);
     }
 
     function generateImageGrid(photoUrls, name, id) {
@@ -0,0 +1,139 @@
+# FINGERPRINTING STATIC ASSETS FOR LONG-LIVED BROWSER CACHING
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+ASSET_EXTENSIONS = {".css", ".js", ".ico", ".png", ".jpg", ".jpeg", ".gif", ".svg"}
+# Text-like files worth storing pre-compressed
+COMPRESS_EXTENSIONS = {".css", ".js", ".ico", ".svg"}
+# Build output (rewritten stylesheets, .gz/.br copies and the manifest) lives under static/dist
+DIST_DIR = "dist"
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+CSS_URL_RE = re.compile(r"url\((['\"]?)/static/([^)'\"]+)\1\)")
+FINGERPRINT_RE = re.compile(r"^(.+)\.[0-9a-f]{12}(\.[^./]+)$")
+
+
+def atomic_write_json(file_path, data):
+    # Write to a temp file in the same directory and rename it over the original, so readers
+    # (including other gunicorn workers) only ever see the old or the new file, never half of one
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file, indent=4)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def fingerprinted(path, digest):
+    # css/styles.css -> css/styles.1a2b3c4d5e6f.css
+    root, ext = os.path.splitext(path)
+    return f"{root}.{digest}{ext}"
+
+
+def unfingerprinted(path):
+    # css/styles.1a2b3c4d5e6f.css -> css/styles.css, or None if path has no fingerprint
+    match = FINGERPRINT_RE.match(path)
+    return f"{match[1]}{match[2]}" if match else None
+
+
+def content_digest(data):
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def manifest_digest(manifest):
+    # Changes whenever any asset's fingerprint does, e.g. on a CSS/JS-only deploy
+    return content_digest(json.dumps(manifest, sort_keys=True).encode("utf-8"))
+
+
+def build_asset_manifest(static_folder, skip_dirs=()):
+    # Maps each asset's path to a URL path containing a hash of its content, plus the file
+    # (and any pre-compressed copies) to serve for it. Only the stylesheets are copied, as
+    # their url(/static/...) references are rewritten to fingerprinted URLs too; every other
+    # asset is served from its original file
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    skip_dirs = {os.path.normpath(path) for path in (DIST_DIR, *skip_dirs)}
+    paths = []
+    for root, dirs, files in os.walk(static_folder):
+        relative_root = os.path.relpath(root, static_folder)
+        dirs[:] = [
+            name
+            for name in dirs
+            if os.path.normpath(os.path.join(relative_root, name)) not in skip_dirs
+        ]
+        for name in files:
+            if os.path.splitext(name)[1].lower() in ASSET_EXTENSIONS:
+                paths.append(
+                    os.path.normpath(os.path.join(relative_root, name)).replace(
+                        os.sep, "/"
+                    )
+                )
+
+    manifest = {}
+    stylesheets = []
+    for path in sorted(paths):
+        if path.endswith(".css"):
+            stylesheets.append(path)
+            continue
+        with open(os.path.join(static_folder, path), "rb") as file:
+            digest = content_digest(file.read())
+        manifest[path] = {"url": fingerprinted(path, digest), "file": path}
+
+    def rewrite_url(match):
+        asset = manifest.get(match[2])
+        return f"url({match[1]}/static/{asset['url'] if asset else match[2]}{match[1]})"
+
+    for path in stylesheets:
+        with open(os.path.join(static_folder, path), "r", encoding="utf-8") as file:
+            data = CSS_URL_RE.sub(rewrite_url, file.read()).encode("utf-8")
+        built_path = f"{DIST_DIR}/{path}"
+        os.makedirs(
+            os.path.dirname(os.path.join(static_folder, built_path)), exist_ok=True
+        )
+        with open(os.path.join(static_folder, built_path), "wb") as file:
+            file.write(data)
+        manifest[path] = {
+            "url": fingerprinted(path, content_digest(data)),
+            "file": built_path,
+        }
+
+    compressors = [("gzip", ".gz", lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli:
+        compressors.insert(0, ("br", ".br", lambda data: brotli.compress(data)))
+    for path, asset in manifest.items():
+        asset["encodings"] = {}
+        if os.path.splitext(path)[1].lower() not in COMPRESS_EXTENSIONS:
+            continue
+        with open(os.path.join(static_folder, asset["file"]), "rb") as file:
+            data = file.read()
+        for encoding, suffix, compress in compressors:
+            compressed = compress(data)
+            # Not worth a second file unless it saves at least a tenth
+            if len(compressed) < len(data) * 0.9:
+                compressed_path = f"{DIST_DIR}/{path}{suffix}"
+                full_path = os.path.join(static_folder, compressed_path)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                with open(full_path, "wb") as file:
+                    file.write(compressed)
+                asset["encodings"][encoding] = compressed_path
+
+    atomic_write_json(os.path.join(static_folder, MANIFEST_PATH), manifest)
+    return manifest
+
+
+def load_asset_manifest(static_folder):
+    # No manifest (e.g. in development) means plain, unfingerprinted static URLs
+    try:
+        with open(os.path.join(static_folder, MANIFEST_PATH), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
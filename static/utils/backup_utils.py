@@ -0,0 +1,57 @@
+# WRITING AND READING GZIPPED NEWLINE-DELIMITED JSON BACKUPS
+import gzip
+import json
+import zlib
+from datetime import date, datetime
+
+# Compressed output is handed on in pieces of about this many (uncompressed) bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def encode_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Can't back up {type(value).__name__} values")
+
+
+def backup_lines(tables):
+    # tables is an iterable of (table name, iterable of row dicts). Each row becomes one line,
+    # e.g. {"table": "cafes", "row": {"id": 1, ...}}
+    for name, rows in tables:
+        for row in rows:
+            yield json.dumps({"table": name, "row": row}, default=encode_value) + "\n"
+
+
+def gzip_stream(lines):
+    # Gzips the lines as they are produced (wbits=31 writes a gzip header), so a download can
+    # start straight away and never needs the whole backup in memory
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_SIZE:
+            data = compressor.compress("".join(buffer).encode("utf-8"))
+            buffer, size = [], 0
+            if data:
+                yield data
+    yield compressor.compress("".join(buffer).encode("utf-8")) + compressor.flush()
+
+
+def write_backup(path, lines):
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        for line in lines:
+            file.write(line)
+            count += 1
+    return count
+
+
+def read_backup(path):
+    # Yields (table name, row dict) pairs in the order they were written
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield record["table"], record["row"]
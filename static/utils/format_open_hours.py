@@ -0,0 +1,114 @@
+# PARSING GOOGLE'S OPENING HOURS AND CHECKING WHETHER A CAFE IS OPEN
+import re
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+day_abbreviations = {
+    "Monday": "Mon",
+    "Tuesday": "Tue",
+    "Wednesday": "Wed",
+    "Thursday": "Thu",
+    "Friday": "Fri",
+    "Saturday": "Sat",
+    "Sunday": "Sun",
+}
+DAYS = list(day_abbreviations.values())
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+LONDON = ZoneInfo("Europe/London")
+
+# Compiled once at import rather than on every call
+SPACES_RE = re.compile("[\u00a0\u202f\u2009]")
+DAY_SPLIT_RE = re.compile(r",(?=\w)")
+NOTE_RE = re.compile(r"\s*\(.*?\)")
+TIME = r"(\d{1,2}):(\d{2})\s*([AP]M)?"
+# Matches both Google's "8:00 AM - 5:00 PM" and the stored "08:00 – 17:00"
+RANGE_RE = re.compile(rf"{TIME}\s*[-–]\s*{TIME}", re.IGNORECASE)
+
+
+def to_minutes(hour, minute, meridiem):
+    hour, minute = int(hour), int(minute)
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem.upper() == "PM" else 0)
+    return hour * 60 + minute
+
+
+def parse_ranges(time_range):
+    # "8:00 AM – 5:00 PM" -> [(480, 1020)]. A start without AM/PM takes the end's, as in
+    # Google's "8:00 – 11:00 AM"
+    ranges = []
+    for match in RANGE_RE.finditer(time_range):
+        start_hour, start_minute, start_meridiem, end_hour, end_minute, end_meridiem = (
+            match.groups()
+        )
+        ranges.append(
+            (
+                to_minutes(start_hour, start_minute, start_meridiem or end_meridiem),
+                to_minutes(end_hour, end_minute, end_meridiem),
+            )
+        )
+    return ranges
+
+
+def format_opening_hours(weekday_text):
+    # Google's weekday_text, e.g. "Monday: 8:00 AM – 5:00 PM,Tuesday: Closed,...", to the
+    # display strings stored in Cafe.opening_hours, e.g. {"Mon": "08:00 – 17:00", ...}.
+    # Days that can't be read are shown as "N/A"
+    opening_hours_dict = {day: "N/A" for day in DAYS}
+    weekday_text = SPACES_RE.sub(" ", weekday_text or "").replace("–", "-")
+
+    for day_text in DAY_SPLIT_RE.split(weekday_text):
+        weekday, _, time_range = day_text.partition(":")
+        day = day_abbreviations.get(weekday.strip())
+        time_range = time_range.strip()
+        if day is None:
+            continue
+
+        if time_range.lower() == "closed":
+            opening_hours_dict[day] = "Closed"
+        elif time_range.lower() == "open 24 hours":
+            opening_hours_dict[day] = "Open 24 hours"
+        elif "hours might differ" in time_range.lower():
+            opening_hours_dict[day] = time_range
+        else:
+            ranges = parse_ranges(NOTE_RE.sub("", time_range))
+            if ranges:
+                opening_hours_dict[day] = ", ".join(
+                    f"{start // 60:02d}:{start % 60:02d} – {end // 60:02d}:{end % 60:02d}"
+                    for start, end in ranges
+                )
+    return opening_hours_dict
+
+
+def opening_intervals(opening_hours):
+    # Cafe.opening_hours as sorted [start, end) intervals in minutes since Monday 00:00, which
+    # is what Cafe.opening_intervals stores. Ranges that close after midnight run on into the
+    # next day, and Sunday night's wrap round to Monday morning
+    intervals = []
+    for index, day in enumerate(DAYS):
+        hours = (opening_hours or {}).get(day, "")
+        day_start = index * MINUTES_PER_DAY
+        if hours == "Open 24 hours":
+            ranges = [(0, MINUTES_PER_DAY)]
+        else:
+            # Includes the usual hours of days marked "(Hours might differ)"
+            ranges = parse_ranges(NOTE_RE.sub("", hours))
+        for start, end in ranges:
+            if end <= start:
+                end += MINUTES_PER_DAY
+            start, end = day_start + start, day_start + end
+            if end > MINUTES_PER_WEEK:
+                intervals.append([0, end - MINUTES_PER_WEEK])
+                end = MINUTES_PER_WEEK
+            intervals.append([start, end])
+    return sorted(intervals)
+
+
+def london_now():
+    return datetime.now(LONDON)
+
+
+def is_open_at(intervals, when):
+    # when is a datetime in London time, e.g. london_now()
+    minute = when.weekday() * MINUTES_PER_DAY + when.hour * 60 + when.minute
+    return any(start <= minute < end for start, end in intervals or ())
@@ -1,28 +1,186 @@
 # OBTAINING LONDON BOROUGH DATA/DETERMINING A LOCATION'S BOROUGH
-import geopandas as gpd
-from shapely.geometry import Point
+import json
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry import shape
 import os
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+GEOJSON_PATH = os.path.join(
+    current_dir, "..", "..", "static", "geojson", "london_boroughs.geojson"
+)
+# Compact binary copy of the GeoJSON, built with `flask --app main build-boroughs-cache`
+CACHE_PATH = os.path.join(
+    current_dir, "..", "..", "static", "geojson", "london_boroughs.npz"
+)
+# ~2m at London's latitude; keeps borough edges accurate while halving the vertex count
+SIMPLIFY_TOLERANCE = 0.00002
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE = 111320
+# Grid cells of ~1.1km north-south and ~0.7km east-west in London
+GRID_CELL_SIZE = 0.01
 
-def get_boroughs_data():
-    # Load GeoJSON file with borough boundaries
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    relative_path = os.path.join(
-        current_dir, "..", "..", "static", "geojson", "london_boroughs.geojson"
+_boroughs_data = None
+
+
+class BoroughIndex:
+    # Spatial index over the borough polygons. The STRtree narrows a lookup down to the
+    # boroughs whose bounding box contains the point, and the prepared polygons make the
+    # exact point-in-polygon test on those few candidates cheap
+    def __init__(self, names, geometries, bounds=None):
+        self.names = np.asarray(names, dtype=object)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.bounds = shapely.bounds(self.geometries) if bounds is None else bounds
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def find(self, lat, lng):
+        return self.find_many([lat], [lng])[0]
+
+    def find_many(self, lats, lngs):
+        # Classify every point in one vectorized pass; points outside London get "N/A"
+        points = shapely.points(
+            np.asarray(lngs, dtype=float), np.asarray(lats, dtype=float)
+        )
+        point_idx, borough_idx = self.tree.query(points)
+        inside = shapely.contains(self.geometries[borough_idx], points[point_idx])
+
+        result = np.full(len(points), "N/A", dtype=object)
+        result[point_idx[inside]] = self.names[borough_idx[inside]]
+        return result.tolist()
+
+
+def haversine(lat, lng, lats, lngs):
+    # Great-circle distance in metres from one point to arrays of points
+    lat, lng = np.radians(lat), np.radians(lng)
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class CafeGrid:
+    # Buckets cafe coordinates into fixed-size lat/lng cells. A radius search only looks at
+    # the cells overlapping the circle's bounding box, then ranks those few cafes by distance
+    def __init__(self, ids, lats, lngs, cell_size=GRID_CELL_SIZE):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lngs = np.asarray(lngs, dtype=float)
+        self.cell_size = cell_size
+        self.cells = {}
+        rows = np.floor(self.lats / cell_size).astype(np.int64)
+        cols = np.floor(self.lngs / cell_size).astype(np.int64)
+        for index, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            self.cells.setdefault(cell, []).append(index)
+        self.cells = {
+            cell: np.array(indexes, dtype=np.int64)
+            for cell, indexes in self.cells.items()
+        }
+
+    def nearby(self, lat, lng, radius, limit):
+        # Returns up to limit (id, distance in metres) pairs within radius metres, nearest first
+        lat_delta = radius / METRES_PER_DEGREE
+        lng_delta = radius / (METRES_PER_DEGREE * max(np.cos(np.radians(lat)), 0.01))
+        min_lat, max_lat = lat - lat_delta, lat + lat_delta
+        min_lng, max_lng = lng - lng_delta, lng + lng_delta
+
+        candidates = [
+            self.cells[(row, col)]
+            for row in range(
+                int(np.floor(min_lat / self.cell_size)),
+                int(np.floor(max_lat / self.cell_size)) + 1,
+            )
+            for col in range(
+                int(np.floor(min_lng / self.cell_size)),
+                int(np.floor(max_lng / self.cell_size)) + 1,
+            )
+            if (row, col) in self.cells
+        ]
+        if not candidates:
+            return []
+        candidates = np.concatenate(candidates)
+        lats, lngs = self.lats[candidates], self.lngs[candidates]
+        in_box = (
+            (lats >= min_lat)
+            & (lats <= max_lat)
+            & (lngs >= min_lng)
+            & (lngs <= max_lng)
+        )
+        candidates = candidates[in_box]
+
+        distances = haversine(lat, lng, self.lats[candidates], self.lngs[candidates])
+        within = distances <= radius
+        candidates, distances = candidates[within], distances[within]
+        order = np.argsort(distances, kind="stable")[:limit]
+        return list(
+            zip(self.ids[candidates[order]].tolist(), distances[order].tolist())
+        )
+
+
+def build_boroughs_cache(geojson_path=GEOJSON_PATH, cache_path=CACHE_PATH):
+    # Parse the GeoJSON once and store simplified polygons as WKB, with their bounding boxes
+    with open(geojson_path, "r") as file:
+        features = json.load(file)["features"]
+    names = np.array([feature["properties"]["name"] for feature in features])
+    geometries = shapely.simplify(
+        np.array([shape(feature["geometry"]) for feature in features]),
+        SIMPLIFY_TOLERANCE,
+        preserve_topology=True,
     )
-    return gpd.read_file(relative_path)
 
+    bounds = shapely.bounds(geometries)
+
+    if cache_path:
+        wkb = shapely.to_wkb(geometries)
+        offsets = np.cumsum([0] + [len(item) for item in wkb])
+        np.savez(
+            cache_path,
+            names=names,
+            wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+            offsets=offsets,
+            bounds=bounds,
+        )
+    return BoroughIndex(names, geometries, bounds)
+
+
+def load_boroughs_cache(cache_path=CACHE_PATH):
+    with np.load(cache_path) as cache:
+        wkb = cache["wkb"].tobytes()
+        offsets = cache["offsets"]
+        names = cache["names"]
+        bounds = cache["bounds"]
+    geometries = shapely.from_wkb(
+        [wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    )
+    return BoroughIndex(names, geometries, bounds)
 
-def find_borough(lat, lng, boroughs_data):
-    # Create a Point object for the cafe
-    cafe_location = Point(lng, lat)
 
+def get_boroughs_data():
+    # Loaded on first use rather than at import, so workers start without touching the geodata
+    global _boroughs_data
+    if _boroughs_data is None:
+        if os.path.exists(CACHE_PATH):
+            _boroughs_data = load_boroughs_cache()
+        else:
+            _boroughs_data = build_boroughs_cache(cache_path=None)
+    return _boroughs_data
+
+
+def find_borough(lat, lng, boroughs_data=None):
     # Find the borough containing the cafe
-    for _, borough in boroughs_data.iterrows():
-        if cafe_location.within(borough["geometry"]):
-            return borough["name"]
-    else:
-        return "N/A"
+    if boroughs_data is None:
+        boroughs_data = get_boroughs_data()
+    return boroughs_data.find(lat, lng)
+
+
+def find_boroughs(lats, lngs, boroughs_data=None):
+    # Batch version of find_borough, e.g. for re-classifying every cafe at once
+    if boroughs_data is None:
+        boroughs_data = get_boroughs_data()
+    return boroughs_data.find_many(lats, lngs)
 
 
 # # --------------------EXAMPLE--------------------------------
@@ -37,3 +195,5 @@ def find_borough(lat, lng, boroughs_data):
 
 # for location in locations:
 #     print(find_borough(location["latitude"], location["longitude"], boroughs_data))
+
+# print(find_boroughs([l["latitude"] for l in locations], [l["longitude"] for l in locations], boroughs_data))
@@ -0,0 +1,144 @@
+# DOWNLOADING CAFE THUMBNAILS AND MAKING RESIZED COPIES IN THE BACKGROUND
+import hashlib
+import io
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) seconds, so a slow image host can't hold a download thread forever
+DOWNLOAD_TIMEOUT = (5, 30)
+MAX_IMAGE_BYTES = 15 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Resized copies made of each image, at 1x and 2x the size they are shown at. Cards are
+# cropped to 3:2 and avatars to squares; detail images keep their shape
+VARIANTS = {
+    "card": {"widths": (320, 640), "aspect": 3 / 2},
+    "detail": {"widths": (960, 1920), "aspect": None},
+    "avatar": {"widths": (64, 128), "aspect": 1},
+}
+# WebP for browsers that take it, JPEG as the fallback
+FORMATS = {
+    "webp": {"format": "WEBP", "quality": 75, "method": 6},
+    "jpeg": {"format": "JPEG", "quality": 80, "optimize": True, "progressive": True},
+}
+
+
+def make_session(pool_size=8, retries=3):
+    # One pooled session shared by the download threads, so repeat requests to the same
+    # image host reuse their connections. Retries back off on connection errors and 429/5xx
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_image(session, url, save_path):
+    # Streams the image into a temp file next to save_path and renames it into place, so a
+    # half-written or failed download never replaces a good thumbnail
+    directory = os.path.dirname(save_path)
+    os.makedirs(directory, exist_ok=True)
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES:
+                        raise ValueError(f"Image larger than {MAX_IMAGE_BYTES} bytes")
+                    file.write(chunk)
+            # mkstemp creates files readable by the owner only
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, save_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    return save_path
+
+
+def make_variants(source_path, output_dir, kinds, prefix=""):
+    # Writes each variant as <content hash>-<kind>-<width>.<format> in output_dir, so a file
+    # name always means the same bytes and can be cached forever. Returns, per kind and
+    # format, [width, prefix + file name] pairs smallest first, e.g. for building a srcset
+    with open(source_path, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha1(data).hexdigest()[:16]
+    os.makedirs(output_dir, exist_ok=True)
+
+    variants = {}
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    for kind in kinds:
+        spec = VARIANTS[kind]
+        # Never upscale, but always make at least the smallest size
+        widths = [width for width in spec["widths"] if width <= image.width]
+        widths = widths or [min(spec["widths"][0], image.width)]
+        variants[kind] = {name: [] for name in FORMATS}
+        for width in widths:
+            if spec["aspect"]:
+                resized = ImageOps.fit(
+                    image, (width, round(width / spec["aspect"])), Image.LANCZOS
+                )
+            else:
+                height = round(image.height * width / image.width)
+                resized = image.resize((width, height), Image.LANCZOS)
+            for name, options in FORMATS.items():
+                filename = f"{digest}-{kind}-{width}.{name}"
+                path = os.path.join(output_dir, filename)
+                if not os.path.exists(path):
+                    fd, temp_path = tempfile.mkstemp(dir=output_dir, suffix=".part")
+                    os.close(fd)
+                    try:
+                        resized.save(temp_path, **options)
+                        os.chmod(temp_path, 0o644)
+                        os.replace(temp_path, path)
+                    except BaseException:
+                        os.remove(temp_path)
+                        raise
+                variants[kind][name].append([width, prefix + filename])
+    return variants
+
+
+class ImageJobs:
+    # In-process queue of image work (downloads and resizing). Requests only enqueue a job;
+    # the jobs run on a small thread pool and failures are logged
+    def __init__(self, session=None, max_workers=4):
+        self.session = session or make_session(pool_size=max_workers)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="images"
+        )
+
+    def _run(self, task, args):
+        try:
+            task(*args)
+        except Exception as e:
+            print(f"Image job {task.__name__}{args} failed: {e}")
+
+    def _download(self, url, save_path, then):
+        download_image(self.session, url, save_path)
+        print(f"Image successfully downloaded: {save_path}")
+        if then:
+            then(save_path)
+
+    def run(self, task, *args):
+        self.executor.submit(self._run, task, args)
+
+    def submit(self, url, save_path, then=None):
+        # Downloads url to save_path, then calls then(save_path) on the same thread
+        self.run(self._download, url, save_path, then)
@@ -0,0 +1,68 @@
+# READING EXPORTED PLACE LISTS FOR BULK IMPORTS
+import csv
+import gzip
+import json
+from itertools import islice
+
+# Column names used by Google Places exports, mapped to the ones the importer expects
+FIELD_ALIASES = {
+    "google_place_gid": "place_id",
+    "formatted_address": "address",
+    "latitude": "lat",
+    "longitude": "lng",
+    "opening_hours": "weekday_text",
+}
+REQUIRED_FIELDS = ("place_id", "name", "address", "lat", "lng")
+
+
+def read_places(path):
+    # Yields one dict per row of a CSV or JSON lines file (optionally gzipped), without ever
+    # holding the whole file in memory
+    opener = gzip.open if path.endswith(".gz") else open
+    name = path[: -len(".gz")] if path.endswith(".gz") else path
+    with opener(path, "rt", encoding="utf-8", newline="") as file:
+        if name.endswith(".csv"):
+            yield from csv.DictReader(file)
+        elif name.endswith((".jsonl", ".ndjson")):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Can't import {path}: expected .csv, .jsonl or .ndjson")
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def normalize_place(record):
+    # One row in the shape of the suggest form's fields. Raises ValueError for rows that can't
+    # be imported
+    place = {FIELD_ALIASES.get(key, key): value for key, value in record.items()}
+    missing = [field for field in REQUIRED_FIELDS if not place.get(field)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    try:
+        lat, lng = float(place["lat"]), float(place["lng"])
+    except (TypeError, ValueError):
+        raise ValueError(f"bad coordinates {place['lat']}, {place['lng']}")
+
+    weekday_text = place.get("weekday_text") or ""
+    if isinstance(weekday_text, dict):
+        weekday_text = weekday_text.get("weekday_text") or []
+    if isinstance(weekday_text, list):
+        # Joined the way the suggest form sends Google's list
+        weekday_text = ",".join(weekday_text)
+    return {
+        "place_id": str(place["place_id"]).strip(),
+        "name": str(place["name"]).strip(),
+        "address": str(place["address"]).strip(),
+        "postal_code": str(place.get("postal_code") or "").strip(),
+        "lat": lat,
+        "lng": lng,
+        "weekday_text": weekday_text,
+        "img_url": place.get("img_url") or None,
+        "photo_url": place.get("photo_url") or None,
+    }
@@ -0,0 +1,91 @@
+# CACHING RENDERED PAGES
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    # LRU cache with per-entry expiry, local to one worker
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # Kept apart from the LRU entries so a version can never be evicted
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if time.monotonic() > expires:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+
+class RedisBackend:
+    # Shared by every worker, so an invalidation in one worker is seen by all of them
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else value.decode("utf-8")
+
+    def set(self, key, value, ttl):
+        # Redis is configured with an LRU maxmemory-policy, so it handles eviction itself
+        self.client.set(key, value.encode("utf-8"), ex=ttl)
+
+    def get_counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+class PageCache:
+    # Keys include a data version, so invalidate() retires every cached page at once by bumping
+    # the version instead of deleting keys one by one
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+
+    def _key(self, key):
+        version = self.backend.get_counter("page-cache:version")
+        return f"page-cache:{version}:{key}"
+
+    def get(self, key):
+        return self.backend.get(self._key(key))
+
+    def set(self, key, value):
+        self.backend.set(self._key(key), value, self.ttl)
+
+    def invalidate(self):
+        self.backend.incr("page-cache:version")
+
+
+def make_page_cache(url=None, ttl=300):
+    if url and url.startswith(("redis://", "rediss://")):
+        return PageCache(RedisBackend(url), ttl)
+    return PageCache(MemoryBackend(), ttl)
@@ -0,0 +1,62 @@
+# KNOWING WHICH GOOGLE PLACES ARE ALREADY LISTED WITHOUT ASKING THE DATABASE
+import threading
+import time
+from collections import OrderedDict
+
+
+class PlaceIndex:
+    # Every listed place_id is kept in a set, so "is this place listed?" is a set lookup. Summaries
+    # of the listed places asked about most recently are kept in a small LRU. The set is
+    # re-read after the TTL to pick up cafes added by other workers; load_ids() returns every
+    # place_id and load_summary(place_id) one cafe's summary, or None if it isn't listed
+    def __init__(self, load_ids, load_summary, ttl=300, max_summaries=1024):
+        self.load_ids = load_ids
+        self.load_summary = load_summary
+        self.ttl = ttl
+        self.max_summaries = max_summaries
+        self.ids = None
+        self.expires = 0
+        self.summaries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def warm(self):
+        ids = set(self.load_ids())
+        with self.lock:
+            self.ids = ids
+            self.summaries.clear()
+            self.expires = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        with self.lock:
+            self.ids = None
+
+    def _remember(self, place_id, summary):
+        self.summaries[place_id] = summary
+        self.summaries.move_to_end(place_id)
+        while len(self.summaries) > self.max_summaries:
+            self.summaries.popitem(last=False)
+
+    def add(self, place_id, summary):
+        with self.lock:
+            if self.ids is not None:
+                self.ids.add(place_id)
+                self._remember(place_id, summary)
+
+    def get(self, place_id):
+        if self.ids is None or time.monotonic() > self.expires:
+            self.warm()
+        with self.lock:
+            if place_id not in self.ids:
+                return None
+            summary = self.summaries.get(place_id)
+            if summary is not None:
+                self.summaries.move_to_end(place_id)
+                return summary
+
+        summary = self.load_summary(place_id)
+        with self.lock:
+            if summary is None:
+                self.ids.discard(place_id)
+            else:
+                self._remember(place_id, summary)
+        return summary
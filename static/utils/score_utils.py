@@ -0,0 +1,63 @@
+# SCORING MANY CAFES AT ONCE
+import numpy as np
+from functools import lru_cache
+
+# Points for a "medium" rating (doubled for "high"); see score calculating.txt
+BASE_SCORES = {
+    "wifi": 11,
+    "sockets": 11,
+    "long_stay": 5.5,
+    "tables": 5.5,
+    "quiet": 3,
+    "calls": 3,
+}
+DEFAULT_BASE_SCORE = 11 / 15
+
+
+def base_scores(criteria, keys):
+    # Vectorized calculate_score(criterion, "unknown") for a list of criterion dicts.
+    # Returns the rounded scores and a mask of the cafes whose score is "XX"
+    values = np.array(
+        [[criterion.get(key) for key in keys] for criterion in criteria], dtype=object
+    ).reshape(len(criteria), len(keys))
+    unknown = (values == "unknown").any(axis=1)
+    multipliers = (values == "medium") + 2 * (values == "high")
+
+    # Added one criterion at a time, in the same order as the loop in calculate_score,
+    # so the floating point sums (and their rounding) come out identical
+    scores = np.zeros(len(criteria))
+    for column, key in enumerate(keys):
+        scores = (
+            scores + BASE_SCORES.get(key, DEFAULT_BASE_SCORE) * multipliers[:, column]
+        )
+    # np.rint rounds halves to even, like Python's round()
+    return np.rint(scores), unknown
+
+
+def apply_like_levels(scores, like_levels):
+    # The heart rating's rounding rules: low rounds down to the nearest 10, medium to the
+    # nearest number ending in 5 and high rounds up to the nearest 10
+    like_levels = np.asarray(like_levels, dtype=object)
+    rounded_down = np.floor_divide(scores - 0.1, 10) * 10
+    return np.select(
+        [like_levels == "low", like_levels == "medium", like_levels == "high"],
+        [rounded_down, rounded_down + 5, np.ceil(scores / 10) * 10],
+        scores,
+    )
+
+
+@lru_cache(maxsize=None)
+def like_level_score(score, like_level):
+    # A user's score for a cafe: the cafe's score with their heart rating's rounding applied.
+    # Derived on demand so it can never go stale when the cafe's criteria change. Only ~400
+    # (score, like_level) pairs exist, so each is computed once per worker
+    if score == "XX":
+        return "XX"
+    return str(int(apply_like_levels(np.array([float(score)]), [like_level])[0]))
+
+
+def format_scores(scores, unknown):
+    return [
+        "XX" if is_unknown else str(int(score))
+        for score, is_unknown in zip(scores.tolist(), unknown.tolist())
+    ]
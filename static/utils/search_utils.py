@@ -0,0 +1,196 @@
+# SEARCHING CAFE NAMES, ADDRESSES AND REVIEWS WITH AN IN-MEMORY INVERTED INDEX
+import math
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+from markupsafe import Markup, escape
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+WORD_RE = re.compile(r"[^\W_]+")
+# How much one occurrence of a word counts in each field
+FIELD_WEIGHTS = {"name": 3.0, "address": 1.5, "reviews": 1.0}
+# Caps how many indexed words a half-typed last word can expand to
+MAX_PREFIX_TERMS = 50
+SNIPPET_CHARS = 160
+
+
+def normalize(text):
+    # "Café" -> "cafe"
+    text = text or ""
+    if text.isascii():
+        return text.lower()
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+class SearchIndex:
+    # Maps each word to the cafes containing it and how strongly (see FIELD_WEIGHTS). A cafe's
+    # entry is replaced on its own by set_cafe, so writes only re-index the cafes they touch.
+    # The texts are kept too, to cut snippets from. Each cafe has a slot, and searches score
+    # every slot at once with numpy arrays of each word's postings
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.slots = {}
+        self.slot_cafe_ids = []
+        self.free_slots = []
+        # Postings as (slots, weights) arrays, made on first use after each change
+        self.arrays = {}
+        # Sorted words, for matching the last word as a prefix; re-sorted after new words
+        self.terms = []
+        self.terms_dirty = False
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def set_cafe(self, cafe_id, name, address, reviews):
+        fields = {"name": [name or ""], "address": [address or ""], "reviews": reviews}
+        weights = Counter()
+        for field, texts in fields.items():
+            for text in texts:
+                for token in tokenize(text):
+                    weights[token] += FIELD_WEIGHTS[field]
+
+        with self.lock:
+            self._remove(cafe_id)
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.slot_cafe_ids[slot] = cafe_id
+            else:
+                slot = len(self.slot_cafe_ids)
+                self.slot_cafe_ids.append(cafe_id)
+            self.slots[cafe_id] = slot
+            for term, weight in weights.items():
+                if term not in self.postings:
+                    self.postings[term] = {}
+                    self.terms_dirty = True
+                self.postings[term][slot] = weight
+                self.arrays.pop(term, None)
+            self.documents[cafe_id] = (fields, weights)
+
+    def remove_cafe(self, cafe_id):
+        with self.lock:
+            self._remove(cafe_id)
+
+    def _remove(self, cafe_id):
+        document = self.documents.pop(cafe_id, None)
+        if document is None:
+            return
+        slot = self.slots.pop(cafe_id)
+        self.slot_cafe_ids[slot] = None
+        self.free_slots.append(slot)
+        for term in document[1]:
+            postings = self.postings[term]
+            del postings[slot]
+            self.arrays.pop(term, None)
+            if not postings:
+                del self.postings[term]
+                self.terms_dirty = True
+
+    def _arrays(self, term):
+        arrays = self.arrays.get(term)
+        if arrays is None:
+            postings = self.postings[term]
+            arrays = (
+                np.fromiter(postings.keys(), dtype=np.intp, count=len(postings)),
+                np.fromiter(postings.values(), dtype=float, count=len(postings)),
+            )
+            self.arrays[term] = arrays
+        return arrays
+
+    def _matching_terms(self, token, prefix):
+        if not prefix:
+            return [token] if token in self.postings else []
+        if self.terms_dirty:
+            self.terms = sorted(self.postings)
+            self.terms_dirty = False
+        terms = []
+        for term in self.terms[bisect_left(self.terms, token) :]:
+            if not term.startswith(token) or len(terms) == MAX_PREFIX_TERMS:
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query, limit=20):
+        # Cafes matching every word of the query, best first, as (cafe_id, score, snippet).
+        # The last word may still be being typed, so it also matches the words it starts
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self.lock:
+            scores = None
+            for position, token in enumerate(tokens):
+                # Each cafe's best match for this word
+                token_scores = np.zeros(len(self.slot_cafe_ids))
+                for term in self._matching_terms(token, position == len(tokens) - 1):
+                    slots, weights = self._arrays(term)
+                    idf = math.log(1 + len(self.documents) / len(slots))
+                    # Saturates, so a word repeated across many reviews can't outweigh a
+                    # match in the name
+                    token_scores[slots] = np.maximum(
+                        token_scores[slots], idf * weights / (weights + 1.2)
+                    )
+                if scores is None:
+                    scores = token_scores
+                else:
+                    # Only cafes matching every word so far keep a score
+                    scores = np.where(token_scores > 0, scores + token_scores, 0)
+                if not scores.any():
+                    return []
+
+            matched = np.flatnonzero(scores)
+            if len(matched) > limit:
+                matched = matched[np.argpartition(-scores[matched], limit)[:limit]]
+            ranked = matched[np.argsort(-scores[matched], kind="stable")]
+            return [
+                (
+                    self.slot_cafe_ids[slot],
+                    float(scores[slot]),
+                    self._snippet(self.slot_cafe_ids[slot], tokens),
+                )
+                for slot in ranked.tolist()
+            ]
+
+    def _snippet(self, cafe_id, tokens):
+        # The address or review with the most query words, cut down to SNIPPET_CHARS around
+        # the first match, with the matches in <mark>
+        fields = self.documents[cafe_id][0]
+        best_text, best_matches = fields["address"][0], []
+        for text in fields["address"] + fields["reviews"]:
+            matches = [
+                match
+                for match in WORD_RE.finditer(text)
+                if word_matches(normalize(match[0]), tokens)
+            ]
+            if len(matches) > len(best_matches):
+                best_text, best_matches = text, matches
+
+        start = 0
+        if best_matches and len(best_text) > SNIPPET_CHARS:
+            start = max(0, best_matches[0].start() - SNIPPET_CHARS // 3)
+        end = start + SNIPPET_CHARS
+        pieces = ["…"] if start else []
+        position = start
+        for match in best_matches:
+            if match.start() < position or match.end() > end:
+                continue
+            pieces.append(escape(best_text[position : match.start()]))
+            pieces.append(Markup("<mark>%s</mark>") % match[0])
+            position = match.end()
+        pieces.append(escape(best_text[position:end]))
+        if end < len(best_text):
+            pieces.append("…")
+        return Markup("").join(pieces)
+
+
+def word_matches(word, tokens):
+    return word in tokens[:-1] or word.startswith(tokens[-1])
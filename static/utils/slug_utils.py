@@ -0,0 +1,19 @@
+# CONVERTING NAMES TO URL SLUGS
+import json
+import re
+
+
+def slugify(text):
+    # e.g. convert the string London Bridge to london-bridge
+    return re.sub(r"[^a-z0-9-]", "", text.lower().replace(" ", "-"))
+
+
+def load_slugged_names(file_path):
+    # {name: slug} from the slugged names file used before slugs were stored in the db.
+    # Empty if the file is missing or unreadable
+    try:
+        with open(file_path, "r") as file:
+            content = file.read()
+        return json.loads(content) if content.strip() else {}
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
@@ -0,0 +1,84 @@
+# CHECKS THE VECTORIZED SCORING IN score_utils AGAINST calculate_score
+# Run from the repo root with `python -m pytest tests` (or `python -m unittest discover tests`)
+# after changing any weights or rounding rules
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_URI", "sqlite://")
+os.environ.setdefault("SECRET_KEY", "test")
+
+from main import CRITERIA, calculate_score
+from static.utils.score_utils import (
+    apply_like_levels,
+    base_scores,
+    format_scores,
+    like_level_score,
+)
+
+RANDOM_CASES = 50_000
+LEVELS = ("unknown", "low", "medium", "high", None)
+LIKE_LEVELS = ("unknown", "low", "medium", "high")
+
+
+def random_criterion(rng):
+    # Some criteria are left out entirely, the rest get any level, including None
+    return {key: rng.choice(LEVELS) for key in CRITERIA if rng.random() > 0.1}
+
+
+def vectorized_scores(criteria, like_levels):
+    scores, unknown = base_scores(criteria, CRITERIA)
+    return format_scores(apply_like_levels(scores, like_levels), unknown)
+
+
+class ScoreParityTest(unittest.TestCase):
+    def assert_parity(self, criteria, like_levels):
+        expected = [
+            calculate_score(criterion, like_level)
+            for criterion, like_level in zip(criteria, like_levels)
+        ]
+        self.assertEqual(vectorized_scores(criteria, like_levels), expected)
+
+        # Users' scores are derived from the cafe's score rather than its criteria
+        cafe_scores = vectorized_scores(criteria, ["unknown"] * len(criteria))
+        self.assertEqual(
+            [
+                like_level_score(score, like_level)
+                for score, like_level in zip(cafe_scores, like_levels)
+            ],
+            expected,
+        )
+
+    def test_random_criteria(self):
+        rng = random.Random(15)
+        criteria = [random_criterion(rng) for _ in range(RANDOM_CASES)]
+        # Mostly without "unknown", or nearly every case would just be "XX"
+        for criterion in criteria[: RANDOM_CASES // 2]:
+            for key, value in criterion.items():
+                if value == "unknown":
+                    criterion[key] = rng.choice(LEVELS[1:])
+        like_levels = [rng.choice(LIKE_LEVELS) for _ in criteria]
+        self.assert_parity(criteria, like_levels)
+
+    def test_edge_cases(self):
+        criteria = [
+            {},
+            {key: "low" for key in CRITERIA},
+            {key: "low" for key in CRITERIA},
+            {key: None for key in CRITERIA},
+            {key: "high" for key in CRITERIA},
+            {**{key: "high" for key in CRITERIA}, "wifi": "unknown"},
+            {"wifi": "medium", "calls": "high"},
+        ]
+        like_levels = ["low", "low", "high", "medium", "high", "low", "unknown"]
+        self.assert_parity(criteria, like_levels)
+        # A cafe rated 0 that someone rates low goes below zero, as calculate_score does
+        self.assertEqual(calculate_score({"wifi": "low"}, "low"), "-10")
+        self.assertEqual(like_level_score("0", "low"), "-10")
+        self.assertEqual(like_level_score("XX", "high"), "XX")
+
+
+if __name__ == "__main__":
+    unittest.main()